@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""Compare hash_file with file_digests (one pass over the file for several algorithms).
+
+Run from the repository root: python benchmarks/checksum.py [--size-mib N] [--repeat N]
+The file is read once before timing, so all cases read it from the page cache.
+"""
+import argparse
+import dataclasses
+import os
+import tempfile
+import time
+from pathlib import Path
+
+from cachitool.checksum import file_digests, hash_file
+from cachitool.config import get_config, set_config
+from cachitool.paths import CacheDir
+
+
+def best_of(repeat, fn):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--size-mib", type=int, default=256, help="size of the test file")
+    parser.add_argument("--repeat", type=int, default=3, help="report the best of N runs")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp, "data.bin")
+        with path.open("wb") as f:
+            for _ in range(args.size_mib):
+                f.write(os.urandom(1024 * 1024))
+        hash_file(path)
+
+        set_config(dataclasses.replace(get_config(), cache_dir=None))
+        cases = {
+            "hash_file sha256": lambda: hash_file(path).hexdigest(),
+            "file_digests [sha256]": lambda: file_digests(path, ["sha256"]),
+            "hash_file sha256 + hash_file sha512": lambda: (
+                hash_file(path).hexdigest(),
+                hash_file(path, algorithm="sha512").hexdigest(),
+            ),
+            "file_digests [sha256, sha512]": lambda: file_digests(path, ["sha256", "sha512"]),
+        }
+        print(f"{args.size_mib} MiB file, best of {args.repeat}, {os.cpu_count()} CPUs")
+        for name, fn in cases.items():
+            print(f"  {name:<45} {best_of(args.repeat, fn):.3f}s")
+
+        # The second and later runs are answered by the DigestCache
+        set_config(dataclasses.replace(get_config(), cache_dir=CacheDir(tmp, "cache")))
+        timing = best_of(args.repeat, lambda: file_digests(path, ["sha256", "sha512"]))
+        print(f"  {'file_digests [sha256, sha512], DigestCache':<45} {timing:.3f}s")
+
+
+if __name__ == "__main__":
+    main()
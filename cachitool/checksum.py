@@ -1,11 +1,39 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 
 import hashlib
+import logging
+import os
+import sqlite3
+import threading
 from pathlib import Path
-from typing import Union
+from typing import Iterable, Union
 
+from cachitool.config import get_config
 from cachitool.errors import UnknownHashAlgorithm
 
+log = logging.getLogger(__name__)
+
+# Size of the buffers used by file_digests, large reads are much faster than the small ones
+# used by hash_file (and hashlib releases the GIL for large updates)
+HASH_BUFFER_SIZE = 1024 * 1024
+
+# Each thread reuses its own buffer, so that hashing many files does not allocate much
+_buffers = threading.local()
+
+
+def new_hasher(algorithm: str):
+    """Create a new hash object for the algorithm.
+
+    :param str algorithm: the algorithm name.
+    :return: a hash object.
+    :rtype: Hasher
+    :raise UnknownHashAlgorithm: if the algorithm cannot be found.
+    """
+    try:
+        return hashlib.new(algorithm)
+    except ValueError:
+        raise UnknownHashAlgorithm(f"Hash algorithm {algorithm} is unknown.")
+
 
 def hash_file(file_path: Union[str, Path], chunk_size: int = 10240, algorithm: str = "sha256"):
     """Hash a file.
@@ -18,11 +46,179 @@ def hash_file(file_path: Union[str, Path], chunk_size: int = 10240, algorithm: s
     :rtype: Hasher
     :raise UnknownHashAlgorithm: if the algorithm cannot be found.
     """
-    try:
-        hasher = hashlib.new(algorithm)
-    except ValueError:
-        raise UnknownHashAlgorithm(f"Hash algorithm {algorithm} is unknown.")
+    hasher = new_hasher(algorithm)
     with open(file_path, "rb") as f:
         while chunk := f.read(chunk_size):
             hasher.update(chunk)
     return hasher
+
+
+def _get_buffer(buffer_size: int) -> bytearray:
+    buffer = getattr(_buffers, "buffer", None)
+    if buffer is None or len(buffer) != buffer_size:
+        buffer = bytearray(buffer_size)
+        _buffers.buffer = buffer
+    return buffer
+
+
+class DigestCache:
+    """
+    Remember the digests of files, so that unchanged files do not need to be read again.
+
+    Digests are stored in an sqlite database, keyed by the (device, inode, size, mtime_ns) of
+    the file. Hardlinks to the same file share an inode, so files linked from the artifact
+    store share the digests as well. A file that was modified in place without changing its
+    size and mtime would get stale digests, the --paranoid option disables the cache.
+
+    The cache is an optimization only, errors are logged and otherwise ignored.
+    """
+
+    def __init__(self, db_path: Path):
+        """
+        Initialize a DigestCache.
+
+        :param Path db_path: path to the sqlite database, created if it does not exist
+        """
+        self.db_path = db_path
+        self._local = threading.local()
+
+    def _connect(self) -> sqlite3.Connection:
+        # sqlite connections cannot be shared between threads
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS digests (
+                    dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER,
+                    algorithm TEXT, digest TEXT,
+                    PRIMARY KEY (dev, ino, size, mtime_ns, algorithm)
+                )
+                """
+            )
+            self._local.conn = conn
+        return conn
+
+    def get(self, stat: os.stat_result) -> dict[str, str]:
+        """
+        Get the known digests of a file.
+
+        :param os.stat_result stat: the stat result of the file
+        :return: mapping of algorithm name to hex digest, empty if nothing is known
+        """
+        try:
+            rows = self._connect().execute(
+                """
+                SELECT algorithm, digest FROM digests
+                WHERE dev = ? AND ino = ? AND size = ? AND mtime_ns = ?
+                """,
+                (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns),
+            )
+            return dict(rows.fetchall())
+        except sqlite3.Error as e:
+            log.warning("Failed to read from the digest cache %s: %s", self.db_path, e)
+            return {}
+
+    def put(self, stat: os.stat_result, digests: dict[str, str]) -> None:
+        """
+        Remember the digests of a file.
+
+        :param os.stat_result stat: the stat result of the file (before it was hashed)
+        :param dict digests: mapping of algorithm name to hex digest
+        """
+        key = (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        try:
+            with self._connect() as conn:
+                # Forget the digests of previous contents of the same inode
+                conn.execute(
+                    """
+                    DELETE FROM digests
+                    WHERE dev = ? AND ino = ? AND (size != ? OR mtime_ns != ?)
+                    """,
+                    key,
+                )
+                conn.executemany(
+                    "INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?, ?)",
+                    [(*key, algorithm, digest) for algorithm, digest in digests.items()],
+                )
+        except sqlite3.Error as e:
+            log.warning("Failed to write to the digest cache %s: %s", self.db_path, e)
+
+
+_digest_caches: dict[Path, DigestCache] = {}
+_digest_caches_lock = threading.Lock()
+
+
+def get_digest_cache() -> DigestCache | None:
+    """Get the DigestCache in the configured cache_dir, None if disabled (or --paranoid)."""
+    config = get_config()
+    if config.cache_dir is None or config.paranoid:
+        return None
+    db_path = config.cache_dir.digests
+    with _digest_caches_lock:
+        cache = _digest_caches.get(db_path)
+        if cache is None:
+            cache = DigestCache(db_path)
+            _digest_caches[db_path] = cache
+        return cache
+
+
+def remember_digests(file_path: Union[str, Path], digests: dict[str, str]) -> None:
+    """Add digests that were computed some other way (e.g. while downloading) to the DigestCache.
+
+    :param file_path: the file the digests belong to.
+    :type file_path: str, pathlib.Path
+    :param dict digests: mapping of algorithm name to hex digest.
+    """
+    digest_cache = get_digest_cache()
+    if digest_cache is not None and digests:
+        digest_cache.put(os.stat(file_path), digests)
+
+
+def _compute_digests(file_path, algorithms, buffer_size) -> dict[str, str]:
+    hashers = {algorithm: new_hasher(algorithm) for algorithm in algorithms}
+    buffer = _get_buffer(buffer_size)
+    view = memoryview(buffer)
+    with open(file_path, "rb", buffering=0) as f:
+        while n := f.readinto(buffer):
+            chunk = view[:n]
+            for hasher in hashers.values():
+                hasher.update(chunk)
+    return {algorithm: hasher.hexdigest() for algorithm, hasher in hashers.items()}
+
+
+def file_digests(
+    file_path: Union[str, Path], algorithms: Iterable[str], buffer_size: int = HASH_BUFFER_SIZE
+) -> dict[str, str]:
+    """Compute the digests of a file for several algorithms, reading the file only once.
+
+    Digests that are in the DigestCache are not computed again.
+
+    :param file_path: compute digests for this file.
+    :type file_path: str, pathlib.Path
+    :param algorithms: names of the algorithms to use.
+    :param int buffer_size: read the file in chunks of this size.
+    :return: mapping of algorithm name to hex digest.
+    :rtype: dict[str, str]
+    :raise UnknownHashAlgorithm: if any of the algorithms cannot be found.
+    """
+    algorithms = set(algorithms)
+    digest_cache = get_digest_cache()
+    if digest_cache is None:
+        return _compute_digests(file_path, algorithms, buffer_size)
+
+    stat = os.stat(file_path)
+    cached = digest_cache.get(stat)
+    missing = algorithms - cached.keys()
+    if missing:
+        computed = _compute_digests(file_path, missing, buffer_size)
+        # Do not remember the digests if the file changed while it was being read
+        new_stat = os.stat(file_path)
+        if (new_stat.st_size, new_stat.st_mtime_ns) == (stat.st_size, stat.st_mtime_ns):
+            digest_cache.put(stat, computed)
+        cached.update(computed)
+    else:
+        log.debug("Using cached digests of %s", file_path)
+    return {algorithm: cached[algorithm] for algorithm in algorithms}
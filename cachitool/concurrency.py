@@ -0,0 +1,147 @@
+import contextlib
+import logging
+import os
+import threading
+import time
+from typing import Iterator
+
+log = logging.getLogger(__name__)
+
+
+class HostLimiter:
+    """Limit the number of concurrent operations against a single host."""
+
+    def __init__(self, per_host: int):
+        """
+        Initialize a HostLimiter.
+
+        :param int per_host: maximum number of concurrent operations per host
+        """
+        self.per_host = per_host
+        self._semaphores: dict[str, threading.BoundedSemaphore] = {}
+        self._lock = threading.Lock()
+
+    def _get_semaphore(self, host: str) -> threading.BoundedSemaphore:
+        with self._lock:
+            semaphore = self._semaphores.get(host)
+            if semaphore is None:
+                semaphore = threading.BoundedSemaphore(self.per_host)
+                self._semaphores[host] = semaphore
+            return semaphore
+
+    @contextlib.contextmanager
+    def limit(self, host: str | None) -> Iterator[None]:
+        """Block until an operation against this host is allowed to start."""
+        if host is None:
+            yield
+            return
+        with self._get_semaphore(host):
+            yield
+
+
+class TokenBucket:
+    """
+    Limit the average rate of operations, allow bursts of up to `capacity`.
+
+    Acquiring more tokens than are available puts the bucket in debt, the caller (and anyone
+    after it) then waits until the debt is paid off. This way, a single acquire() call can
+    take any number of tokens.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        """
+        Initialize a TokenBucket.
+
+        :param float rate: number of tokens added per second
+        :param float capacity: maximum number of tokens in the bucket
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, tokens: float = 1) -> None:
+        """Take tokens from the bucket, wait until the bucket is no longer in debt."""
+        with self._lock:
+            self._refill()
+            self._tokens -= tokens
+            wait = -self._tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+    def pause(self, seconds: float) -> None:
+        """Do not allow any operations for the next `seconds`."""
+        with self._lock:
+            self._refill()
+            self._tokens = min(self._tokens, -seconds * self.rate)
+
+
+class AdaptiveLimit:
+    """
+    Limit the number of concurrent operations, adjust the limit based on feedback (AIMD).
+
+    The limit grows by one for every `limit` successful operations (additive increase) and is
+    halved when an operation fails due to overload (multiplicative decrease). Operations that
+    were running at the same time as the failed one are likely to fail as well, so the limit
+    is decreased at most once per `decrease_interval`.
+    """
+
+    def __init__(self, maximum: int, minimum: int = 1, decrease_interval: float = 1.0):
+        """
+        Initialize an AdaptiveLimit, the limit starts at the maximum.
+
+        :param int maximum: maximum number of concurrent operations
+        :param int minimum: the limit never decreases below this
+        :param float decrease_interval: minimum number of seconds between decreases
+        """
+        self.maximum = maximum
+        self.minimum = minimum
+        self.decrease_interval = decrease_interval
+        self.limit = float(maximum)
+        self._in_flight = 0
+        self._last_decrease = float("-inf")
+        self._condition = threading.Condition()
+
+    def acquire(self) -> None:
+        """Block until an operation is allowed to start."""
+        with self._condition:
+            while self._in_flight >= int(self.limit):
+                self._condition.wait()
+            self._in_flight += 1
+
+    def release(self) -> None:
+        """Mark an operation as finished."""
+        with self._condition:
+            self._in_flight -= 1
+            self._condition.notify()
+
+    def increase(self) -> None:
+        """Report a successful operation."""
+        with self._condition:
+            if self.limit < self.maximum:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+                self._condition.notify_all()
+
+    def decrease(self) -> bool:
+        """Report an operation that failed due to overload, return True if the limit changed."""
+        with self._condition:
+            now = time.monotonic()
+            if now - self._last_decrease < self.decrease_interval or self.limit <= self.minimum:
+                return False
+            self._last_decrease = now
+            self.limit = max(self.minimum, self.limit / 2)
+            return True
+
+
+def cpu_count() -> int:
+    """Get the number of CPUs available to this process."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
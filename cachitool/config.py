@@ -0,0 +1,45 @@
+from dataclasses import dataclass
+
+from cachitool.paths import CacheDir
+
+
+@dataclass
+class Config:
+    """Settings that apply to the whole cachitool run (as opposed to a single package)."""
+
+    # maximum number of dependencies to download at the same time
+    jobs: int = 1
+    # maximum number of concurrent downloads from a single host
+    jobs_per_host: int = 4
+    # directory for caches shared between runs, None disables caching
+    cache_dir: CacheDir | None = None
+    # maximum number of VCS dependencies to fetch at the same time
+    vcs_jobs: int = 4
+    # maximum number of concurrent fetches from a single git host
+    vcs_jobs_per_host: int = 2
+    # maximum average number of requests per second to a single host, None means unlimited
+    # (until the host gets overloaded)
+    requests_per_host: float | None = None
+    # maximum total download rate in bytes per second, None means unlimited
+    max_bandwidth: int | None = None
+    # always hash files, do not use digests cached from previous runs
+    paranoid: bool = False
+    # number of threads that compress a source archive, None means one per CPU
+    archive_threads: int | None = None
+    # gzip compression level of source archives (0-9)
+    archive_compression_level: int = 9
+    # only fetch the dependencies that changed since the previous run into the same output dir,
+    # remove the ones that are not needed anymore
+    incremental: bool = False
+
+
+_config = Config()
+
+
+def get_config() -> Config:
+    return _config
+
+
+def set_config(config: Config) -> None:
+    global _config
+    _config = config
@@ -0,0 +1,112 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+import io
+from typing import BinaryIO, Iterator
+
+LZW_MAGIC = b"\x1f\x9d"
+
+_INIT_BITS = 9
+_BIT_MASK = 0x1F
+_BLOCK_MODE = 0x80
+_CLEAR = 256
+
+
+class LZWError(Exception):
+    """The data is not valid LZW compressed data (as produced by compress(1))."""
+
+
+def _read_exactly(fileobj: BinaryIO, size: int) -> bytes:
+    data = fileobj.read(size)
+    while data and len(data) < size:
+        more = fileobj.read(size - len(data))
+        if not more:
+            break
+        data += more
+    return data
+
+
+def iter_decompress(fileobj: BinaryIO) -> Iterator[bytes]:
+    """Decompress a .Z file (LZW, as produced by compress(1)) one chunk at a time.
+
+    compress writes codes in groups of 8 (a group of n-bit codes takes n bytes). When the code
+    size grows or the table is cleared, the rest of the current group is padding.
+
+    :param fileobj: a binary file object positioned at the start of the .Z data.
+    :return: an iterator of decompressed chunks.
+    :raise LZWError: if the data is not valid LZW compressed data.
+    """
+    header = _read_exactly(fileobj, 3)
+    if len(header) < 3 or header[:2] != LZW_MAGIC:
+        raise LZWError("Not LZW compressed data (bad magic number)")
+
+    max_bits = header[2] & _BIT_MASK
+    block_mode = bool(header[2] & _BLOCK_MODE)
+    if not _INIT_BITS <= max_bits <= 16:
+        raise LZWError(f"Unsupported maximum code size: {max_bits} bits")
+    max_max_code = 1 << max_bits
+
+    n_bits = _INIT_BITS
+    # With block mode, code 256 clears the table, it does not stand for any string
+    table = [bytes([i]) for i in range(256)] + ([b""] if block_mode else [])
+    first_free = len(table)
+    prev = None
+
+    while group := _read_exactly(fileobj, n_bits):
+        value = int.from_bytes(group, "little")
+        mask = (1 << n_bits) - 1
+        chunks = []
+
+        for i in range(len(group) * 8 // n_bits):
+            code = (value >> (i * n_bits)) & mask
+
+            if block_mode and code == _CLEAR and prev is not None:
+                del table[first_free:]
+                n_bits = _INIT_BITS
+                prev = None
+                break
+
+            if code < len(table) and (prev is not None or code < 256):
+                entry = table[code]
+            elif code == len(table) and prev is not None:
+                # The code that is just being defined: previous string + its first byte
+                entry = prev + prev[:1]
+            else:
+                raise LZWError(f"Corrupt LZW compressed data (invalid code {code})")
+
+            if prev is not None and len(table) < max_max_code:
+                table.append(prev + entry[:1])
+            chunks.append(entry)
+            prev = entry
+
+            if n_bits < max_bits and len(table) >= 1 << n_bits:
+                n_bits += 1
+                break
+
+        yield b"".join(chunks)
+
+
+class LZWReader(io.RawIOBase):
+    """Read-only file object that decompresses a .Z file, see iter_decompress."""
+
+    def __init__(self, fileobj: BinaryIO):
+        """
+        Initialize an LZWReader.
+
+        :param fileobj: a binary file object positioned at the start of the .Z data
+        """
+        self._chunks = iter_decompress(fileobj)
+        self._pending = b""
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while not self._pending:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return 0
+            self._pending = chunk
+
+        n = min(len(buffer), len(self._pending))
+        buffer[:n] = self._pending[:n]
+        self._pending = self._pending[n:]
+        return n
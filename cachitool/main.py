@@ -1,14 +1,21 @@
 #!/usr/bin/env python3
+from __future__ import annotations
+
 import argparse
 import json
 import logging
+import math
 from pathlib import Path
-from typing import TypedDict, TypeVar
+from typing import TYPE_CHECKING, TypedDict, TypeVar
+
+from cachitool.config import Config, set_config
+from cachitool.paths import CacheDir, OutputDir, default_cache_dir
 
-from cachitool.models.input import PkgSpec, PipPkgSpec, make_package_spec
-from cachitool.models.output import ResolvedRequest
-from cachitool.paths import OutputDir
-from cachitool.pkg_managers import pip
+# The models (pydantic) and package managers (requests, git, bs4, ...) take a long time to import,
+# they are only imported by the subcommands that need them
+if TYPE_CHECKING:
+    from cachitool.models.input import PkgSpec
+    from cachitool.models.output import ResolvedRequest
 
 
 logging.basicConfig(level=logging.DEBUG, format="%(asctime)s [%(levelname)-10s] %(message)s")
@@ -54,6 +61,83 @@ def add_fetch_deps_args(parser: argparse.ArgumentParser) -> None:
         help="directory for Cachito outputs",
         default=".",
     )
+    parser.add_argument(
+        "--jobs",
+        help="download up to N dependencies at the same time (default: 1)",
+        metavar="N",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--jobs-per-host",
+        help="download up to N dependencies from the same host at the same time (default: 4)",
+        metavar="N",
+        type=int,
+        default=4,
+    )
+    parser.add_argument(
+        "--vcs-jobs",
+        help="fetch up to N VCS dependencies at the same time (default: 4)",
+        metavar="N",
+        type=int,
+        default=4,
+    )
+    parser.add_argument(
+        "--vcs-jobs-per-host",
+        help="fetch up to N VCS dependencies from the same git host at the same time (default: 2)",
+        metavar="N",
+        type=int,
+        default=2,
+    )
+    parser.add_argument(
+        "--requests-per-host",
+        help="send at most RATE requests per second to the same host (default: no limit, "
+        "until the host reports being overloaded)",
+        metavar="RATE",
+        type=float,
+    )
+    parser.add_argument(
+        "--max-bandwidth",
+        help="limit the total download rate to RATE bytes per second, accepts K, M and G "
+        "suffixes (e.g. 10M)",
+        metavar="RATE",
+    )
+    parser.add_argument(
+        "--archive-threads",
+        help="compress source archives on N threads (default: the number of CPUs)",
+        metavar="N",
+        type=int,
+    )
+    parser.add_argument(
+        "--archive-compression-level",
+        help="gzip compression level of source archives, from 0 (none) to 9 (default: 9)",
+        metavar="LEVEL",
+        type=int,
+        default=9,
+    )
+    parser.add_argument(
+        "--paranoid",
+        help="always hash files and verify archives, do not trust digests and verification "
+        "results cached from previous runs",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--incremental",
+        help="only fetch the dependencies that changed since the previous --incremental run with "
+        "the same output dir, remove the ones that are not needed anymore",
+        action="store_true",
+    )
+    cache_exclusive = parser.add_mutually_exclusive_group()
+    cache_exclusive.add_argument(
+        "--cache-dir",
+        help=f"directory for caches shared between runs (default: {default_cache_dir()})",
+        default=str(default_cache_dir()),
+    )
+    cache_exclusive.add_argument(
+        "--no-cache",
+        help="do not use or update any caches",
+        action="store_true",
+    )
 
 
 def add_apply_configs_args(parser: argparse.ArgumentParser) -> None:
@@ -72,9 +156,12 @@ def add_apply_configs_args(parser: argparse.ArgumentParser) -> None:
 class FetchDepsArgs(TypedDict):
     packages: list[PkgSpec]
     output_dir: OutputDir
+    config: Config
 
 
 def convert_fetch_deps_args(args: argparse.Namespace) -> FetchDepsArgs:
+    from cachitool.models.input import make_package_spec
+
     def parse_pkg_arg(pkg_arg: str) -> PkgSpec:
         pkg_type, _, path = pkg_arg.partition(":")
         return make_package_spec({"type": pkg_type, "path": path})
@@ -95,9 +182,40 @@ def convert_fetch_deps_args(args: argparse.Namespace) -> FetchDepsArgs:
     packages = [load_pkg(pkg_arg) for pkg_arg in args.package]
     packagelist = load_pkg_list(args.packagelist)
 
+    if args.jobs < 1:
+        raise ValueError("--jobs: must be at least 1")
+    if args.jobs_per_host < 1:
+        raise ValueError("--jobs-per-host: must be at least 1")
+    if args.vcs_jobs < 1:
+        raise ValueError("--vcs-jobs: must be at least 1")
+    if args.vcs_jobs_per_host < 1:
+        raise ValueError("--vcs-jobs-per-host: must be at least 1")
+    if args.archive_threads is not None and args.archive_threads < 1:
+        raise ValueError("--archive-threads: must be at least 1")
+    if not 0 <= args.archive_compression_level <= 9:
+        raise ValueError("--archive-compression-level: must be between 0 and 9")
+    if args.requests_per_host is not None and not args.requests_per_host > 0:
+        raise ValueError("--requests-per-host: must be greater than 0")
+    max_bandwidth = None
+    if args.max_bandwidth is not None:
+        max_bandwidth = parse_bandwidth("--max-bandwidth", args.max_bandwidth)
+
     return {
         "packages": packages or packagelist,
         "output_dir": OutputDir(args.output_dir),
+        "config": Config(
+            jobs=args.jobs,
+            jobs_per_host=args.jobs_per_host,
+            vcs_jobs=args.vcs_jobs,
+            vcs_jobs_per_host=args.vcs_jobs_per_host,
+            cache_dir=None if args.no_cache else CacheDir(args.cache_dir),
+            requests_per_host=args.requests_per_host,
+            max_bandwidth=max_bandwidth,
+            paranoid=args.paranoid,
+            archive_threads=args.archive_threads,
+            archive_compression_level=args.archive_compression_level,
+            incremental=args.incremental,
+        ),
     }
 
 
@@ -133,6 +251,24 @@ def maybe_load_json(cli_arg: str, raw_data: str, expect_t: type[T]) -> T | None:
     return data
 
 
+def parse_bandwidth(cli_arg: str, raw_data: str) -> int:
+    multipliers = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3}
+    number = raw_data.strip().upper().removesuffix("B")
+    suffix = number[-1:] if number[-1:] in multipliers else ""
+    try:
+        value = float(number.removesuffix(suffix))
+    except ValueError:
+        raise ValueError(f"{cli_arg}: expected a number with an optional K, M or G suffix")
+    value *= multipliers[suffix]
+    if not math.isfinite(value):
+        raise ValueError(f"{cli_arg}: must be a finite number of bytes per second")
+
+    rate = int(value)
+    if rate < 1:
+        raise ValueError(f"{cli_arg}: must be at least 1 byte per second")
+    return rate
+
+
 def process_output(output: ResolvedRequest, output_dir: OutputDir) -> None:
     log.info("writing config files to %s", output_dir.configs_file)
 
@@ -168,7 +304,11 @@ def run_fetch_deps(cli_args: FetchDepsArgs) -> None:
     if not cli_args["packages"]:
         parser.error("no packages to process")
 
+    from cachitool.models.input import PipPkgSpec
+    from cachitool.pkg_managers import pip
+
     output_dir = cli_args["output_dir"]
+    set_config(cli_args["config"])
 
     pip_pkgs = [pkg for pkg in cli_args["packages"] if isinstance(pkg, PipPkgSpec)]
     output = pip.resolve_pip(pip_pkgs, output_dir)
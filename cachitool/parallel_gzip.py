@@ -0,0 +1,135 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+import collections
+import io
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO
+
+# Size of the blocks that are compressed independently (the same as pigz uses)
+BLOCK_SIZE = 128 * 1024
+# Each block is compressed with the end of the previous block as the preset dictionary, so that
+# splitting the data costs almost nothing in compression ratio. Deflate can't look further back.
+DICTIONARY_SIZE = 32 * 1024
+
+_COMPRESS_LEVEL_FAST = 1
+_COMPRESS_LEVEL_BEST = 9
+
+
+def _gzip_header(compresslevel: int) -> bytes:
+    """Make a gzip header without a file name and timestamp, the same as gzip.GzipFile would."""
+    if compresslevel == _COMPRESS_LEVEL_BEST:
+        xfl = 2
+    elif compresslevel == _COMPRESS_LEVEL_FAST:
+        xfl = 4
+    else:
+        xfl = 0
+    # magic, deflate, no flags, mtime 0, extra flags, unknown OS
+    return struct.pack("<BBBBLBB", 0x1F, 0x8B, 8, 0, 0, xfl, 255)
+
+
+def _compress_block(block: bytes, dictionary: bytes, compresslevel: int, last: bool) -> bytes:
+    """Compress one block to raw deflate data that can be concatenated with the next block.
+
+    Blocks other than the last one end with a sync flush (an empty stored block), so the data of
+    the next block starts at a byte boundary. The last block ends the deflate stream.
+    """
+    if dictionary:
+        compressor = zlib.compressobj(
+            compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=dictionary
+        )
+    else:
+        compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS)
+    flush_mode = zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH
+    return compressor.compress(block) + compressor.flush(flush_mode)
+
+
+class ParallelGzipWriter(io.RawIOBase):
+    """Write-only file object that compresses to gzip on several threads, in the style of pigz.
+
+    The data is split into blocks that are compressed on a thread pool (zlib releases the GIL)
+    and written out in order. The output is a single standard gzip stream, it does not depend on
+    the number of threads.
+    """
+
+    def __init__(
+        self,
+        fileobj: BinaryIO,
+        threads: int = 1,
+        compresslevel: int = _COMPRESS_LEVEL_BEST,
+        block_size: int = BLOCK_SIZE,
+    ):
+        """
+        Initialize a ParallelGzipWriter and write the gzip header.
+
+        :param fileobj: a binary file object to write the compressed data to, it is not closed
+        :param int threads: compress up to this many blocks at the same time
+        :param int compresslevel: zlib compression level, from 0 (no compression) to 9
+        :param int block_size: size of the blocks of uncompressed data
+        """
+        if threads < 1:
+            raise ValueError(f"threads must be at least 1, got {threads}")
+        if not 0 <= compresslevel <= 9:
+            raise ValueError(f"compresslevel must be between 0 and 9, got {compresslevel}")
+
+        self._fileobj = fileobj
+        self._compresslevel = compresslevel
+        self._block_size = max(block_size, DICTIONARY_SIZE)
+        # With a single thread, compress in the calling thread
+        self._executor = ThreadPoolExecutor(threads) if threads > 1 else None
+        # Keep all threads busy, but don't hold more than a few blocks in memory
+        self._max_pending = 2 * threads
+        self._pending = collections.deque()
+        self._buffer = bytearray()
+        self._dictionary = b""
+        self._crc = 0
+        self._size = 0
+        self._fileobj.write(_gzip_header(compresslevel))
+
+    def writable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        """Get the number of uncompressed bytes written so far."""
+        return self._size + len(self._buffer)
+
+    def write(self, data) -> int:
+        if self.closed:
+            raise ValueError("write to closed file")
+        self._buffer += data
+        while len(self._buffer) >= self._block_size:
+            block = bytes(self._buffer[: self._block_size])
+            del self._buffer[: self._block_size]
+            self._submit(block, last=False)
+        return len(data)
+
+    def close(self) -> None:
+        """Compress the remaining data and write the gzip trailer, the fileobj stays open."""
+        if self.closed:
+            return
+        try:
+            self._submit(bytes(self._buffer), last=True)
+            self._buffer.clear()
+            while self._pending:
+                self._fileobj.write(self._pending.popleft().result())
+            self._fileobj.write(struct.pack("<LL", self._crc, self._size & 0xFFFFFFFF))
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown(cancel_futures=True)
+            super().close()
+
+    def _submit(self, block: bytes, last: bool) -> None:
+        self._crc = zlib.crc32(block, self._crc)
+        self._size += len(block)
+        dictionary = self._dictionary
+        self._dictionary = block[-DICTIONARY_SIZE:]
+
+        if self._executor is None:
+            self._fileobj.write(_compress_block(block, dictionary, self._compresslevel, last))
+            return
+
+        self._pending.append(
+            self._executor.submit(_compress_block, block, dictionary, self._compresslevel, last)
+        )
+        if len(self._pending) >= self._max_pending:
+            self._fileobj.write(self._pending.popleft().result())
@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+import os
 from pathlib import Path
 from typing import Any, TYPE_CHECKING
 if TYPE_CHECKING:
@@ -40,3 +41,19 @@ class OutputDir(SafePath):
     configs_file = subpath("configs.json")
     env_file = subpath("env.json")
     content_manifest = subpath("content-manifest.json")
+
+
+class CacheDir(SafePath):
+    http = subpath("http")
+    artifacts = subpath("artifacts")
+    digests = subpath("digests.sqlite")
+    sdist_metadata = subpath("sdist-metadata")
+    git_mirrors = subpath("git")
+    verified_archives = subpath("verified-archives")
+    vcs_archives = subpath("vcs-archives")
+    requirements_files = subpath("requirements-files")
+
+
+def default_cache_dir() -> Path:
+    cache_home = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(cache_home, "cachitool")
@@ -0,0 +1,164 @@
+import logging
+import queue
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Iterable
+
+log = logging.getLogger(__name__)
+
+_DONE = object()
+
+
+@dataclass
+class Stage:
+    """A step of a Pipeline, processed by a pool of worker threads."""
+
+    name: str
+    fn: Callable[[Any], Any]
+    workers: int = 1
+
+    # statistics, updated while the pipeline runs
+    processed: int = field(default=0, init=False)
+    busy_seconds: float = field(default=0.0, init=False)
+    max_queue_depth: int = field(default=0, init=False)
+    queue_depth_total: int = field(default=0, init=False)
+    queue_depth_samples: int = field(default=0, init=False)
+
+    def stats(self) -> str:
+        samples = self.queue_depth_samples
+        avg_depth = self.queue_depth_total / samples if samples else 0.0
+        return (
+            f"{self.name}: {self.processed} items, {self.busy_seconds:.2f}s busy, "
+            f"queue depth avg {avg_depth:.1f} max {self.max_queue_depth}"
+        )
+
+
+class Pipeline:
+    """
+    Process items through a sequence of stages, stages work on different items at the same time.
+
+    Stages are connected by bounded queues, so a fast stage cannot run too far ahead of a slow
+    one. Each stage has its own pool of worker threads, so e.g. network-bound stages can use
+    more workers than CPU-bound ones. The depth of each queue is sampled while the pipeline
+    runs, a stage with a deep input queue is a bottleneck.
+    """
+
+    def __init__(
+        self, stages: list[Stage], queue_size: int = 16, report_interval: float = 5.0
+    ):
+        """
+        Initialize a Pipeline.
+
+        :param list[Stage] stages: the stages, in processing order
+        :param int queue_size: maximum number of items waiting for each stage
+        :param float report_interval: log queue depths every this many seconds
+        """
+        self.stages = stages
+        self.queue_size = queue_size
+        self.report_interval = report_interval
+
+    def run(self, items: Iterable[Any]) -> list[Any]:
+        """
+        Run all items through all stages, return the results in the order of items.
+
+        If processing of any item fails, the items after it are not processed further. The items
+        ahead of it still finish, so the exception re-raised is always that of the first failed
+        item (in the order of items).
+        """
+        items = list(items)
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+        results: dict[int, Any] = {}
+        errors: dict[int, BaseException] = {}
+        # index of the first failed item so far, items after it are skipped
+        first_failed = len(items)
+        finished = threading.Event()
+        lock = threading.Lock()
+
+        def feed():
+            for i, item in enumerate(items):
+                if i > first_failed:
+                    break
+                queues[0].put((i, item))
+            for _ in range(self.stages[0].workers):
+                queues[0].put(_DONE)
+
+        remaining_workers = [stage.workers for stage in self.stages]
+
+        def work(stage_index: int):
+            nonlocal first_failed
+            stage = self.stages[stage_index]
+            in_queue = queues[stage_index]
+            is_last = stage_index == len(self.stages) - 1
+
+            while (entry := in_queue.get()) is not _DONE:
+                i, item = entry
+                if i > first_failed:
+                    continue
+                start = time.monotonic()
+                try:
+                    result = stage.fn(item)
+                except BaseException as e:
+                    with lock:
+                        errors[i] = e
+                        first_failed = min(first_failed, i)
+                    continue
+                finally:
+                    with lock:
+                        stage.processed += 1
+                        stage.busy_seconds += time.monotonic() - start
+                if is_last:
+                    with lock:
+                        results[i] = result
+                else:
+                    queues[stage_index + 1].put((i, result))
+
+            with lock:
+                remaining_workers[stage_index] -= 1
+                last_worker = remaining_workers[stage_index] == 0
+            if last_worker and not is_last:
+                for _ in range(self.stages[stage_index + 1].workers):
+                    queues[stage_index + 1].put(_DONE)
+
+        def monitor():
+            last_report = time.monotonic()
+            while not finished.wait(0.1):
+                depths = [q.qsize() for q in queues]
+                for stage, depth in zip(self.stages, depths):
+                    stage.queue_depth_total += depth
+                    stage.queue_depth_samples += 1
+                    stage.max_queue_depth = max(stage.max_queue_depth, depth)
+                if time.monotonic() - last_report >= self.report_interval:
+                    last_report = time.monotonic()
+                    log.debug(
+                        "Pipeline queue depths: %s",
+                        ", ".join(f"{s.name}={d}" for s, d in zip(self.stages, depths)),
+                    )
+
+        threads = [threading.Thread(target=feed, name="pipeline-feed", daemon=True)]
+        for stage_index, stage in enumerate(self.stages):
+            threads.extend(
+                threading.Thread(
+                    target=work,
+                    args=(stage_index,),
+                    name=f"pipeline-{stage.name}-{n}",
+                    daemon=True,
+                )
+                for n in range(stage.workers)
+            )
+        monitor_thread = threading.Thread(target=monitor, name="pipeline-monitor", daemon=True)
+
+        monitor_thread.start()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        finished.set()
+        monitor_thread.join()
+
+        for stage in self.stages:
+            log.info("Pipeline stage %s", stage.stats())
+
+        if errors:
+            raise errors[min(errors)]
+        return [results[i] for i in range(len(items))]
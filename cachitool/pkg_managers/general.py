@@ -1,33 +1,54 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 import collections
+import fcntl
+import json
 import logging
 import os
+import threading
 import urllib
+from pathlib import Path
 from typing import Dict
 
 import requests
 
-from cachitool.checksum import hash_file
+from cachitool.checksum import file_digests, hash_file, new_hasher, remember_digests
+from cachitool.config import get_config
 from cachitool.errors import InvalidChecksum, InvalidRequestData, NetworkError, UnknownHashAlgorithm
 # from cachito.workers import nexus
 # from cachito.workers.config import get_worker_config
 from cachitool.requests import (
     SAFE_REQUEST_METHODS,
     get_requests_session,
+    limit_bandwidth,
     # requests_auth_session,
 )
+from cachitool.store import STORE_ALGORITHM, ArtifactStore
 
 __all__ = [
     # "update_request_with_config_files",
     "verify_checksum",
+    "verify_digest",
     "ChecksumInfo",
 ]
 
 log = logging.getLogger(__name__)
 
 ChecksumInfo = collections.namedtuple("ChecksumInfo", "algorithm hexdigest")
+DownloadResult = collections.namedtuple("DownloadResult", "digests size")
 
-pkg_requests_session = get_requests_session(retry_options={"allowed_methods": SAFE_REQUEST_METHODS})
+_pkg_requests_session = None
+_pkg_requests_session_lock = threading.Lock()
+
+
+def get_pkg_requests_session():
+    """Get the requests session for downloading packages, created on first use."""
+    global _pkg_requests_session
+    with _pkg_requests_session_lock:
+        if _pkg_requests_session is None:
+            _pkg_requests_session = get_requests_session(
+                retry_options={"allowed_methods": SAFE_REQUEST_METHODS}, cache=True, throttle=True
+            )
+        return _pkg_requests_session
 
 
 # def _get_request_url(request_id):
@@ -125,8 +146,18 @@ def verify_checksum(file_path: str, checksum_info: ChecksumInfo, chunk_size: int
         msg = f"Cannot perform checksum on the file {filename}, {exc}"
         raise InvalidChecksum(msg)
 
-    computed_hexdigest = hasher.hexdigest()
+    verify_digest(filename, hasher.hexdigest(), checksum_info)
 
+
+def verify_digest(filename: str, computed_hexdigest: str, checksum_info: ChecksumInfo):
+    """
+    Verify that an already computed digest matches the expected checksum info.
+
+    :param str filename: name of the file the digest was computed for (for error messages)
+    :param str computed_hexdigest: the computed hex digest
+    :param ChecksumInfo checksum_info: the expected checksum information
+    :raise InvalidChecksum: if the checksum is not as expected
+    """
     if computed_hexdigest != checksum_info.hexdigest:
         msg = (
             f"The file {filename} has an unexpected checksum value, "
@@ -135,26 +166,311 @@ def verify_checksum(file_path: str, checksum_info: ChecksumInfo, chunk_size: int
         raise InvalidChecksum(msg)
 
 
-def download_binary_file(url, download_path, auth=None, insecure=False, chunk_size=8192):
+def _get_download(url, auth=None, insecure=False, headers=None):
+    try:
+        resp = get_pkg_requests_session().get(
+            url, stream=True, verify=not insecure, auth=auth, headers=headers
+        )
+        resp.raise_for_status()
+    except requests.RequestException as e:
+        if e.response is not None:
+            e.response.close()
+        raise NetworkError(f"Could not download {url}: {e}")
+    return resp
+
+
+def _load_part_info(info_path):
+    try:
+        with open(info_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _is_same_file(f, path):
+    try:
+        return os.path.samestat(os.fstat(f.fileno()), os.stat(path))
+    except FileNotFoundError:
+        return False
+
+
+def _open_locked_part_file(part_path, download_path):
+    """Open the .part file for appending and lock it, waiting for other downloads to finish."""
+    while True:
+        f = open(part_path, "ab+")
+        fcntl.flock(f, fcntl.LOCK_EX)
+        # While waiting for the lock, the file may have been completed or deleted
+        if _is_same_file(f, part_path) or download_path.exists():
+            return f
+        f.close()
+
+
+def _fsync_dir(dir_path):
+    fd = os.open(dir_path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _verify_digests(filename, digests, expected_hashes):
+    """
+    Check that the digests match at least one of the expected hashes.
+
+    Hashes with an algorithm that is missing from the digests are not considered. If no
+    hash can be checked, do nothing (the caller has to verify the file some other way).
+
+    :raise InvalidChecksum: if none of the checked hashes match
+    """
+    checked = False
+    for hash_spec in expected_hashes:
+        algorithm, _, digest = hash_spec.partition(":")
+        if algorithm not in digests:
+            continue
+        checked = True
+        try:
+            verify_digest(filename, digests[algorithm], ChecksumInfo(algorithm, digest))
+            return
+        except InvalidChecksum as e:
+            log.warning("%s", e)
+
+    if checked:
+        raise InvalidChecksum(
+            f"Failed to verify checksum of {filename} against any of the provided hashes"
+        )
+
+
+def download_binary_file(
+    url,
+    download_path,
+    auth=None,
+    insecure=False,
+    chunk_size=8192,
+    algorithms=(),
+    expected_hashes=(),
+):
     """
     Download a binary file (such as a TAR archive) from a URL.
 
+    The file is hashed with the requested algorithms while it is being written, so that
+    verifying it afterwards does not require reading it again.
+
+    The content is written to a <download_path>.part file, which is renamed to download_path
+    only after the size and hash checks pass. If a previous download was interrupted and
+    the server supports range requests, the download resumes where the .part file ends.
+    Concurrent downloads to the same path (from threads or processes) are serialized.
+
     :param str url: URL for file download
     :param (str | Path) download_path: Path to download file to
     :param requests.auth.AuthBase auth: Authentication for the URL
     :param bool insecure: Do not verify SSL for the URL
     :param int chunk_size: Chunk size param for Response.iter_content()
-    :raise NetworkError: If download failed
+    :param algorithms: names of hash algorithms to compute while downloading, unknown
+        algorithms are skipped
+    :param expected_hashes: hash specifiers ("algorithm:digest"), the file must match at
+        least one of them (hashes with unknown algorithms are not checked)
+    :return: the hex digests of the file (mapping of algorithm to digest) and its size
+    :rtype: DownloadResult
+    :raise NetworkError: If download failed or the body does not match the Content-Length
+    :raise InvalidChecksum: If the file does not match any of the expected hashes
     """
-    try:
-        resp = pkg_requests_session.get(url, stream=True, verify=not insecure, auth=auth)
-        resp.raise_for_status()
-    except requests.RequestException as e:
-        raise NetworkError(f"Could not download {url}: {e}")
+    download_path = Path(download_path)
+    part_path = download_path.with_name(f"{download_path.name}.part")
+    # Remembers what the .part file is a part of and whether the server supports ranges
+    info_path = download_path.with_name(f"{download_path.name}.part.info")
+
+    algorithms = {*algorithms, *_get_hash_algorithms(expected_hashes)}
+    hashers = {}
+    for algorithm in algorithms:
+        try:
+            hashers[algorithm] = new_hasher(algorithm)
+        except UnknownHashAlgorithm:
+            log.debug("Will not compute %s digest for %s, unknown algorithm", algorithm, url)
+
+    with _open_locked_part_file(part_path, download_path) as f:
+        if download_path.exists():
+            log.debug("%s was downloaded by another task in the meantime", download_path.name)
+            if _is_same_file(f, part_path):
+                part_path.unlink()
+            digests = file_digests(download_path, hashers)
+            return DownloadResult(digests, download_path.stat().st_size)
+
+        offset = f.seek(0, os.SEEK_END)
+        part_info = _load_part_info(info_path)
+        headers = {}
+        if offset and part_info.get("url") == url and part_info.get("accept_ranges"):
+            headers["Range"] = f"bytes={offset}-"
+            if part_info.get("validator"):
+                headers["If-Range"] = part_info["validator"]
+
+        resp = _get_download(url, auth, insecure, headers)
+
+        if resp.status_code == 206 and resp.headers.get("Content-Range", "").startswith(
+            f"bytes {offset}-"
+        ):
+            log.info("Resuming download of %s at byte %d", download_path.name, offset)
+            f.seek(0)
+            while offset > f.tell():
+                chunk = f.read(min(chunk_size, offset - f.tell()))
+                for hasher in hashers.values():
+                    hasher.update(chunk)
+        else:
+            if offset:
+                log.debug("Cannot resume download of %s, starting over", download_path.name)
+                offset = 0
+            if resp.status_code == 206:
+                # The server did not honor the range we asked for, ask for the whole file
+                resp.close()
+                resp = _get_download(url, auth, insecure)
+            f.truncate(0)
+
+        with open(info_path, "w") as info_f:
+            json.dump(
+                {
+                    "url": url,
+                    "accept_ranges": resp.headers.get("Accept-Ranges") == "bytes",
+                    "validator": resp.headers.get("ETag") or resp.headers.get("Last-Modified"),
+                },
+                info_f,
+            )
+
+        # With Content-Encoding, Content-Length is the size of the encoded body, not of the file
+        expected_size = None
+        if "Content-Encoding" not in resp.headers and "Content-Length" in resp.headers:
+            expected_size = offset + int(resp.headers["Content-Length"])
+
+        size = offset
+        with resp:
+            try:
+                for chunk in resp.iter_content(chunk_size=chunk_size):
+                    size += len(chunk)
+                    if expected_size is not None and size > expected_size:
+                        part_path.unlink()
+                        raise NetworkError(
+                            f"Could not download {url}: body is larger than "
+                            f"the advertised Content-Length ({expected_size - offset})"
+                        )
+                    f.write(chunk)
+                    for hasher in hashers.values():
+                        hasher.update(chunk)
+                    limit_bandwidth(len(chunk))
+            except requests.RequestException as e:
+                raise NetworkError(f"Could not download {url}: {e}")
+
+        f.flush()
+        os.fsync(f.fileno())
+
+        if expected_size is not None and size < expected_size:
+            raise NetworkError(
+                f"Could not download {url}: got {size} bytes, expected {expected_size}"
+            )
+
+        digests = {algorithm: hasher.hexdigest() for algorithm, hasher in hashers.items()}
+        try:
+            _verify_digests(download_path.name, digests, expected_hashes)
+        except InvalidChecksum:
+            part_path.unlink()
+            info_path.unlink(missing_ok=True)
+            raise
+
+        os.rename(part_path, download_path)
+        info_path.unlink(missing_ok=True)
+        _fsync_dir(download_path.parent)
+
+    remember_digests(download_path, digests)
+    return DownloadResult(digests, size)
+
+
+def _get_hash_algorithms(hashes):
+    """
+    Get the names of the algorithms used in hash specifiers.
+
+    :param hashes: hash specifiers - "algorithm:digest"
+    :rtype: set[str]
+    """
+    return {hash_spec.partition(":")[0] for hash_spec in hashes}
+
+
+def get_artifact_store():
+    """Get the ArtifactStore in the configured cache_dir, None if caching is disabled."""
+    cache_dir = get_config().cache_dir
+    if cache_dir is None:
+        return None
+    return ArtifactStore(cache_dir.artifacts)
+
+
+def download_artifact(
+    url,
+    download_path,
+    known_hashes=None,
+    auth=None,
+    insecure=False,
+    algorithms=(),
+    expected_hashes=(),
+):
+    """
+    Download a file through the artifact store (if caching is enabled).
+
+    If the store already has a file matching any of the known hashes, link it to the download
+    path instead of downloading it. Otherwise, download the file and add it to the store.
 
-    with open(download_path, "wb") as f:
-        for chunk in resp.iter_content(chunk_size=chunk_size):
-            f.write(chunk)
+    :param str url: URL for file download
+    :param Path download_path: Path to download file to
+    :param dict known_hashes: expected hashes of the file, mapping of algorithm to hex digest
+    :param requests.auth.AuthBase auth: Authentication for the URL
+    :param bool insecure: Do not verify SSL for the URL
+    :param algorithms: names of hash algorithms to compute while downloading
+    :param expected_hashes: hash specifiers that a downloaded file must match (at least one),
+        see download_binary_file
+    :return: hex digests of the file that were checked against expected_hashes (mapping of
+        algorithm to digest), empty if there are none and the file was found in the store
+    :rtype: dict
+    :raise NetworkError: If download failed
+    :raise InvalidChecksum: If the downloaded file does not match the expected hashes
+    """
+    known_hashes = known_hashes or {}
+    store = get_artifact_store()
+    if store is None:
+        result = download_binary_file(
+            url,
+            download_path,
+            auth=auth,
+            insecure=insecure,
+            algorithms=algorithms,
+            expected_hashes=expected_hashes,
+        )
+        return result.digests
+
+    found = store.find(known_hashes)
+    if found is not None:
+        stored_path, _ = found
+        log.info("Found %s in the artifact store", download_path.name)
+        store.materialize(stored_path, download_path)
+        if not expected_hashes:
+            # The object was not read, don't trust the digests it is stored under. The file
+            # gets hashed when it is verified (and the digests are cached for the shared object).
+            return {}
+        # Hashing goes through the DigestCache, so this only reads the object once
+        digests = file_digests(download_path, _get_hash_algorithms(expected_hashes))
+        try:
+            _verify_digests(download_path.name, digests, expected_hashes)
+            return digests
+        except InvalidChecksum:
+            log.warning("%s in the artifact store is corrupted, downloading it again", stored_path)
+            download_path.unlink()
+            store.discard(stored_path)
+
+    algorithms = {*algorithms, *known_hashes.keys(), STORE_ALGORITHM}
+    result = download_binary_file(
+        url,
+        download_path,
+        auth=auth,
+        insecure=insecure,
+        algorithms=algorithms,
+        expected_hashes=expected_hashes,
+    )
+    store.add(download_path, digests=result.digests)
+    return result.digests
 
 
 # def download_raw_component(raw_component_name, raw_repo_name, download_path, nexus_auth):
@@ -1,18 +1,19 @@
 from itertools import chain
 from pathlib import Path
 
+from cachitool.config import get_config
 from cachitool.models.input import PipPkgSpec
 from cachitool.models.output import ConfigFile, EnvVar, ResolvedRequest, ResolvedPackage, PipResolvedDep
 from cachitool.paths import OutputDir
-from cachitool.pkg_managers.pip.fetch import resolve_pip as _resolve_pip
+from cachitool.pkg_managers.pip.fetch import resolve_pip_packages
 from cachitool.pkg_managers.pip.offline import sync_repo, update_req_file
 
 
 def resolve_pip(pkg_specs: list[PipPkgSpec], output_dir: OutputDir) -> ResolvedRequest:
-    resolved = [
-        _resolve_pip(pkg.path, output_dir, pkg.requirements_files, pkg.requirements_build_files)
-        for pkg in pkg_specs
-    ]
+    resolved = resolve_pip_packages(
+        [(pkg.path, pkg.requirements_files, pkg.requirements_build_files) for pkg in pkg_specs],
+        output_dir,
+    )
 
     packages = []
 
@@ -27,14 +28,15 @@ def resolve_pip(pkg_specs: list[PipPkgSpec], output_dir: OutputDir) -> ResolvedR
         packages.append(resolved_pkg)
 
     all_deps = chain.from_iterable(pkg.dependencies for pkg in packages)
-    repo_dir, external_dir = sync_repo(all_deps, output_dir.pip_local_index)
+    repo_dir, external_dir = sync_repo(
+        all_deps, output_dir.pip_local_index, prune=get_config().incremental
+    )
 
     for pkg, info in zip(packages, resolved):
-        reqfile_paths = [Path(p) for p in info["requirements"]]
         config_files = [
-            ConfigFile(content=content, relpath=reqfile_path.relative_to(pkg.abspath))
-            for reqfile_path in reqfile_paths
-            if (content := update_req_file(reqfile_path, external_dir)) is not None
+            ConfigFile(content=content, relpath=Path(reqfile_path).relative_to(pkg.abspath))
+            for reqfile_path, reqfile in zip(info["requirements"], info["requirements_files"])
+            if (content := update_req_file(reqfile, external_dir)) is not None
         ]
         pkg.config_files = config_files
 
@@ -1,32 +1,49 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 import ast
+import collections
 import configparser
+import email.parser
 import functools
+import gzip
+import hashlib
+import importlib.metadata
+import io
+import json
 import logging
+import lzma
+import multiprocessing
 import os.path
 import random
 import re
 import secrets
 import shutil
 import tarfile
+import tempfile
+import threading
 import urllib
 import zipfile
+import zlib
 from abc import ABC, abstractmethod
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from dataclasses import dataclass
-from pathlib import Path
+from pathlib import Path, PurePosixPath
 from typing import Optional
 
-import bs4
-import pkg_resources
 import requests
+from packaging.requirements import InvalidRequirement, Requirement
 from packaging.utils import canonicalize_name, canonicalize_version
+from packaging.version import InvalidVersion, Version
 
+from cachitool.checksum import file_digests
+from cachitool.concurrency import HostLimiter, cpu_count
+from cachitool.config import get_config, set_config
 from cachitool.errors import (
     FileAccessError,
     InvalidChecksum,
     InvalidRequestData,
     NetworkError,
     NexusError,
+    RepositoryAccessError,
     ValidationError,
 )
 # from cachito.workers import nexus
@@ -38,11 +55,14 @@ from cachitool.pkg_managers.general import (
     ChecksumInfo,
     # download_raw_component,
     extract_git_info,
-    pkg_requests_session,
+    get_pkg_requests_session,
     # upload_raw_package,
     verify_checksum,
+    verify_digest,
 )
-from cachitool.scm import Git
+from cachitool.lzw import LZWError, LZWReader
+from cachitool.pipeline import Pipeline, Stage
+from cachitool.util import strip_url_credentials
 
 log = logging.getLogger(__name__)
 
@@ -58,6 +78,11 @@ COMPRESSED_TAR_EXT = ".tar.Z"
 SDIST_FILE_EXTENSIONS = [ZIP_FILE_EXT, ".tar.gz", ".tar.bz2", ".tar.xz", COMPRESSED_TAR_EXT, ".tar"]
 SDIST_EXT_PATTERN = r"|".join(map(re.escape, SDIST_FILE_EXTENSIONS))
 
+# Simple Repository API content types, see https://peps.python.org/pep-0691/
+SIMPLE_API_JSON = "application/vnd.pypi.simple.v1+json"
+SIMPLE_API_HTML = "application/vnd.pypi.simple.v1+html"
+SIMPLE_API_ACCEPT = f"{SIMPLE_API_JSON}, {SIMPLE_API_HTML};q=0.2, text/html;q=0.01"
+
 
 def get_pip_metadata(package_dir):
     """
@@ -131,7 +156,58 @@ def any_to_version(obj):
         else:
             version = str(version)
 
-    return pkg_resources.safe_version(version)
+    return safe_version(version)
+
+
+def safe_version(version):
+    """
+    Convert an arbitrary string to a standard version string, same as pkg_resources.safe_version.
+
+    :param str version: the version string
+    :rtype: str
+    """
+    try:
+        return str(Version(version))
+    except InvalidVersion:
+        version = version.replace(" ", ".")
+        return re.sub("[^A-Za-z0-9.]+", "-", version)
+
+
+def safe_name(name):
+    """
+    Convert an arbitrary string to a standard distribution name, same as pkg_resources.safe_name.
+
+    Any runs of non-alphanumeric/. characters are replaced with a single '-'.
+
+    :param str name: the distribution name
+    :rtype: str
+    """
+    return re.sub("[^A-Za-z0-9.]+", "-", name)
+
+
+def safe_extra(extra):
+    """
+    Convert an arbitrary string to a standard extra name, same as pkg_resources.safe_extra.
+
+    Any runs of non-alphanumeric characters are replaced with a single '_', and the result is
+    always lowercased.
+
+    :param str extra: the extra name
+    :rtype: str
+    """
+    return re.sub("[^A-Za-z0-9.-]+", "_", extra).lower()
+
+
+# The same names and versions are canonicalized many times (requirement keys, index lookups,
+# sdist checks), remember the results
+@functools.lru_cache(maxsize=None)
+def _canonicalize_name(name):
+    return canonicalize_name(name)
+
+
+@functools.lru_cache(maxsize=None)
+def _canonicalize_version(version):
+    return canonicalize_version(version)
 
 
 def get_top_level_attr(body, attr_name, before_line=None):
@@ -845,7 +921,8 @@ class PipRequirementsFile:
         buffered_line = []
 
         with open(self.file_path) as f:
-            for line in f.read().splitlines():
+            for line in f:
+                line = line.rstrip("\n")
                 if not line.endswith("\\"):
                     buffered_line.append(line)
                     new_line = "".join(buffered_line)
@@ -923,6 +1000,146 @@ class PipRequirementsFile:
         return global_options, requirement_options, " ".join(requirement)
 
 
+# Parsed requirements files (the PipRequirementsFile._parsed dicts) by the sha256 of their content
+_parsed_requirements_files: dict[str, dict] = {}
+
+# Bump this whenever the parsing (e.g. PipRequirement.from_line) or the cached attributes change,
+# the cached entries of other formats are not used
+_REQUIREMENTS_CACHE_FORMAT = 1
+
+# The PipRequirement attributes saved in the parsed requirements cache, in this order
+_CACHED_REQUIREMENT_ATTRS = (
+    "package",
+    "raw_package",
+    "extras",
+    "version_specs",
+    "environment_marker",
+    "hashes",
+    "qualifiers",
+    "kind",
+    "download_line",
+    "options",
+)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_cachitool_version() -> Optional[str]:
+    """Get the installed version of cachitool, or None if it is not installed."""
+    try:
+        return importlib.metadata.version("cachitool")
+    except importlib.metadata.PackageNotFoundError:
+        return None
+
+
+def _get_parsed_requirements_cache_path(digest: str) -> Optional[Path]:
+    """Get the path of the parsed requirements cache entry, or None if not caching."""
+    cache_dir = get_config().cache_dir
+    if cache_dir is None or _get_cachitool_version() is None:
+        return None
+    return cache_dir.requirements_files / digest[:2] / f"{digest}.json"
+
+
+def _load_cached_requirements_file(cache_path: Path) -> Optional[dict]:
+    """
+    Load a parsed requirements file from the cache.
+
+    Entries written by a different version of cachitool or in a different format (see
+    _REQUIREMENTS_CACHE_FORMAT) are ignored, the parsing may differ.
+
+    :param Path cache_path: the path of the cache entry
+    :return: the parsed requirements file (see PipRequirementsFile._parsed) or None
+    """
+    try:
+        entry = json.loads(cache_path.read_text())
+        if (
+            entry["version"] != _get_cachitool_version()
+            or entry.get("format") != _REQUIREMENTS_CACHE_FORMAT
+        ):
+            log.debug(
+                "Ignoring %s, written by cachitool %s in format %s",
+                cache_path,
+                entry["version"],
+                entry.get("format"),
+            )
+            return None
+
+        requirements = []
+        for values in entry["requirements"]:
+            requirement = PipRequirement()
+            for attr, value in zip(_CACHED_REQUIREMENT_ATTRS, values, strict=True):
+                setattr(requirement, attr, value)
+            # JSON has no tuples
+            requirement.extras = tuple(requirement.extras)
+            requirement.version_specs = [tuple(spec) for spec in requirement.version_specs]
+            requirements.append(requirement)
+        return {"requirements": requirements, "options": entry["options"]}
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        log.warning("Ignoring invalid parsed requirements cache entry %s: %s", cache_path, e)
+    return None
+
+
+def _save_cached_requirements_file(cache_path: Path, parsed: dict) -> None:
+    """
+    Save a parsed requirements file to the cache.
+
+    :param Path cache_path: the path of the cache entry
+    :param dict parsed: the parsed requirements file (see PipRequirementsFile._parsed)
+    """
+    entry = {
+        "version": _get_cachitool_version(),
+        "format": _REQUIREMENTS_CACHE_FORMAT,
+        "options": parsed["options"],
+        "requirements": [
+            [getattr(requirement, attr) for attr in _CACHED_REQUIREMENT_ATTRS]
+            for requirement in parsed["requirements"]
+        ],
+    }
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.NamedTemporaryFile("w", dir=cache_path.parent, delete=False) as tmp:
+        json.dump(entry, tmp, separators=(",", ":"))
+    os.replace(tmp.name, cache_path)
+
+
+def load_requirements_file(file_path):
+    """
+    Load and parse a requirements file, parsing each distinct file content only once.
+
+    The same requirements files are used for planning the downloads and then for rewriting them
+    to use the local index, and identical files are common across packages. With a cache dir,
+    the parsed files are also kept on disk, by the file digest, the cachitool version and the
+    cache format.
+
+    :param str file_path: the full path to the requirements file
+    :return: the parsed requirements file
+    :rtype: PipRequirementsFile
+    :raises ValidationError: if the requirements file is invalid
+    """
+    requirements_file = PipRequirementsFile(file_path)
+    digest = file_digests(file_path, ["sha256"])["sha256"]
+    parsed = _parsed_requirements_files.get(digest)
+    if parsed is not None:
+        log.debug("Reusing the parsed requirements file with the same content as %s", file_path)
+        requirements_file._parsed = parsed
+        return requirements_file
+
+    cache_path = _get_parsed_requirements_cache_path(digest)
+    # In paranoid mode, parse the file again, but still refresh the cache entry
+    if cache_path is not None and not get_config().paranoid:
+        parsed = _load_cached_requirements_file(cache_path)
+    if parsed is not None:
+        log.debug("Using the cached parsed requirements file for %s", file_path)
+        requirements_file._parsed = parsed
+    else:
+        parsed = requirements_file._parsed
+        if cache_path is not None:
+            _save_cached_requirements_file(cache_path, parsed)
+
+    _parsed_requirements_files[digest] = parsed
+    return requirements_file
+
+
 class PipRequirement:
     """Parse a requirement and its options from a requirement line."""
 
@@ -1068,34 +1285,27 @@ class PipRequirement:
         else:
             requirement.kind = "pypi"
 
+        # Like pkg_resources.parse_requirements, ignore a trailing " #" comment
+        requirement_string = to_be_parsed.partition(" #")[0].strip()
+        if not requirement_string or requirement_string.startswith("#"):
+            return None
         try:
-            parsed = list(pkg_resources.parse_requirements(to_be_parsed))
-        except (
-            pkg_resources.RequirementParseError,
-            pkg_resources.extern.packaging.requirements.InvalidRequirement,
-        ) as exc:
-            # see https://github.com/pypa/setuptools/pull/2137
+            parsed = Requirement(requirement_string)
+        except InvalidRequirement as exc:
             raise ValidationError(f"Unable to parse the requirement {to_be_parsed!r}: {exc}")
 
-        if not parsed:
-            return None
-        # parse_requirements is able to process a multi-line string, thus returning multiple
-        # parsed requirements. However, since it cannot handle the additional syntax from a
-        # requirements file, we parse each line individually. The conditional below should
-        # never be reached, but is left here to aid diagnosis in case this assumption is
-        # not correct.
-        if len(parsed) > 1:
-            raise ValidationError(f"Multiple requirements per line are not supported, {line!r}")
-        parsed = parsed[0]
-
         hashes, options = cls._split_hashes_from_options(options)
 
         requirement.download_line = to_be_parsed
         requirement.options = options
-        requirement.package = parsed.project_name
+        # Same attributes as the pkg_resources Requirement used to have (project_name, specs
+        # and extras), but in a stable order
+        requirement.package = safe_name(parsed.name)
         requirement.raw_package = parsed.name
-        requirement.version_specs = parsed.specs
-        requirement.extras = parsed.extras
+        requirement.version_specs = sorted(
+            (spec.operator, spec.version) for spec in parsed.specifier
+        )
+        requirement.extras = tuple(sorted(map(safe_extra, parsed.extras)))
         requirement.environment_marker = str(parsed.marker) if parsed.marker else None
         requirement.hashes = hashes
         requirement.qualifiers = qualifiers
@@ -1135,11 +1345,11 @@ class PipRequirement:
 
     @classmethod
     def _adjust_direct_access_requirement(cls, line):
-        """Modify the requirement line so it can be parsed by pkg_resources and extract qualifiers.
+        """Modify the requirement line so it can be parsed by packaging and extract qualifiers.
 
         :param str line: a direct access requirement line
         :return: two-item tuple where the first item is a modified direct access requirement
-            line that can be parsed by pkg_resources, and the second item is a dict of the
+            line that can be parsed by packaging, and the second item is a dict of the
             qualifiers extracted from the direct access URL
         """
         package_name = None
@@ -1172,7 +1382,7 @@ class PipRequirement:
         requirement_parts = [package_name.strip(), "@", url.strip()]
         if environment_marker:
             # Although a space before the semicolon is not needed by pip, it is needed when
-            # using pkg_resources later on.
+            # parsing the requirement later on.
             requirement_parts.append(";")
             requirement_parts.append(environment_marker.strip())
         return " ".join(requirement_parts), qualifiers
@@ -1250,6 +1460,473 @@ class PipRequirement:
 #     return password
 
 
+# Bump this whenever the contents of fetch-state.json change, see DownloadPlan._save_state
+_FETCH_STATE_FORMAT = 1
+
+
+def _get_state_key(key):
+    """
+    Get the key of a download (see _requirement_key) as recorded in fetch-state.json.
+
+    The URL of VCS and URL requirements is stored without credentials.
+
+    :param tuple key: the key of the download
+    :rtype: tuple
+    """
+    kind, name, *rest = key
+    if kind in ("vcs", "url"):
+        rest[0] = strip_url_credentials(rest[0])
+    return (kind, name, *rest)
+
+
+class DownloadPlan:
+    """
+    Download the requirements from many requirements files, each distinct requirement once.
+
+    First, add all the requirements files (this parses and validates them). Then, execute
+    the plan to download every distinct requirement exactly once and verify the results
+    against the hashes of each requirement that refers to them. Finally, get the downloads
+    for each of the added files.
+
+    With the incremental config, the downloads are recorded in fetch-state.json in the workdir.
+    The next incremental run only downloads the requirements that are not recorded there (or
+    whose files are missing) and removes the files that are not needed anymore.
+    """
+
+    def __init__(self, workdir: Path):
+        """
+        Initialize a DownloadPlan.
+
+        :param Path workdir: download the dependencies into deps/pip under this directory
+        """
+        self.workdir = workdir
+        self.pypi_url = "https://pypi.org/"
+        # TODO: will be useful
+        # self.pypi_url = config.pypi_proxy_url
+        # self.pypi_auth = ...
+
+        # For each added file: list of (requirement, key, require_hashes)
+        self._files: list[list[tuple[PipRequirement, tuple, bool]]] = []
+        # Distinct requirements: key -> (requirement, trusted_hosts of its file)
+        self._unique: dict[tuple, tuple[PipRequirement, set[str]]] = {}
+        self._downloads: dict[tuple, dict] | None = None
+        # Paths of the added files, their digests are recorded in the incremental state
+        self._file_paths: list[str] = []
+        self._state_path = workdir / "fetch-state.json"
+
+    def add_requirements_file(self, requirements_file: PipRequirementsFile) -> int:
+        """
+        Add the requirements from a requirements file to the plan.
+
+        :param PipRequirementsFile requirements_file: A requirements.txt file
+        :return: a handle to pass to get_downloads() once the plan is executed
+        :raise ValidationError: If the file has unsupported options or requirements
+        """
+        options = _process_options(requirements_file.options)
+        trusted_hosts = set(options["trusted_hosts"])
+
+        if options["require_hashes"]:
+            log.info("Global --require-hashes option used, will require hashes")
+            require_hashes = True
+        elif any(req.hashes for req in requirements_file.requirements):
+            log.info("At least one dependency uses the --hash option, will require hashes")
+            require_hashes = True
+        else:
+            log.info(
+                "No hash options used, will not require hashes for non-HTTP(S) dependencies. "
+                "HTTP(S) dependencies always require hashes (use the #cachito_hash URL "
+                "qualifier)."
+            )
+            require_hashes = False
+
+        _validate_requirements(requirements_file.requirements)
+        _validate_provided_hashes(requirements_file.requirements, require_hashes)
+
+        entries = []
+        for req in requirements_file.requirements:
+            key = _requirement_key(req, trusted_hosts)
+            if key in self._unique:
+                log.debug("%s is already planned for download", req.download_line)
+            else:
+                self._unique[key] = (req, trusted_hosts)
+            entries.append((req, key, require_hashes))
+
+        self._files.append(entries)
+        self._file_paths.append(requirements_file.file_path)
+        return len(self._files) - 1
+
+    def execute(self) -> None:
+        """
+        Download all the distinct requirements and verify them.
+
+        The work is split into pipelined stages: index lookup and download run on I/O workers
+        (see the jobs and jobs_per_host config), hash verification runs on CPU workers and sdist
+        metadata checks run in a pool of worker processes. VCS dependencies are fetched by a
+        separate pool (see the vcs_jobs and vcs_jobs_per_host config), all of them are started
+        right away and the download stage only waits for the results.
+        """
+        pip_deps_dir = self.workdir / "deps" / "pip"
+        pip_deps_dir.mkdir(parents=True, exist_ok=True)
+
+        config = get_config()
+        host_limiter = HostLimiter(config.jobs_per_host)
+        vcs_host_limiter = HostLimiter(config.vcs_jobs_per_host)
+        cpu_jobs = cpu_count()
+
+        # All the requirements (from all files) that refer to each distinct download
+        referrers = collections.defaultdict(list)
+        for entries in self._files:
+            for req, key, require_hashes in entries:
+                referrers[key].append((req, require_hashes))
+
+        previous = self._load_state() if config.incremental else {}
+
+        def lookup(job):
+            req = job["req"]
+            if req.kind == "pypi" and "info" not in job:
+                with host_limiter.limit(_requirement_host(req, self.pypi_url)):
+                    job["sdist"] = _find_pypi_sdist(req, self.pypi_url)
+            return job
+
+        # Cloning takes seconds of negotiation with the git host, fetch all VCS dependencies
+        # in the background while the other dependencies go through the pipeline
+        vcs_executor = ThreadPoolExecutor(config.vcs_jobs, thread_name_prefix="vcs-fetch")
+        vcs_cancelled = threading.Event()
+        vcs_futures = {}
+
+        def fetch_vcs(job):
+            req = job["req"]
+            with vcs_host_limiter.limit(_requirement_host(req, self.pypi_url)):
+                if vcs_cancelled.is_set():
+                    return None
+                try:
+                    return _download_requirement(
+                        req, pip_deps_dir, self.pypi_url, job["trusted_hosts"]
+                    )
+                except RepositoryAccessError as e:
+                    raise RepositoryAccessError(f"Failed to fetch {req.download_line}: {e}") from e
+
+        def download(job):
+            req = job["req"]
+            if "info" in job:
+                return job
+            if req.kind == "vcs":
+                job["info"] = vcs_futures[job["key"]].result()
+                return job
+            if req.kind == "pypi":
+                host = urllib.parse.urlparse(job["sdist"]["url"]).netloc.rpartition("@")[2]
+            else:
+                host = _requirement_host(req, self.pypi_url)
+            with host_limiter.limit(host):
+                job["info"] = _download_requirement(
+                    req, pip_deps_dir, self.pypi_url, job["trusted_hosts"], job.get("sdist")
+                )
+            return job
+
+        def verify(job):
+            download_info = job["info"]
+            for req, require_hashes in referrers[job["key"]]:
+                if require_hashes or req.kind == "url":
+                    hashes = req.hashes or [req.qualifiers["cachito_hash"]]
+                    _verify_hash(download_info["path"], hashes, download_info.get("digests"))
+            return job
+
+        # Inspecting sdists means decompressing them, which is CPU-bound. Run it in worker
+        # processes, the sdist-check stage threads just wait for the results.
+        sdist_executor = ProcessPoolExecutor(
+            max_workers=cpu_jobs,
+            mp_context=multiprocessing.get_context("forkserver"),
+            initializer=set_config,
+            initargs=(config,),
+        )
+
+        def check_sdist(job):
+            req = job["req"]
+            if req.kind == "pypi":
+                sdist_executor.submit(
+                    check_metadata_in_sdist,
+                    job["info"]["path"],
+                    req.package,
+                    req.version_specs[0][1],
+                ).result()
+            return job
+
+        pipeline = Pipeline(
+            [
+                Stage("index-lookup", lookup, workers=config.jobs),
+                Stage("download", download, workers=config.jobs),
+                Stage("verify", verify, workers=cpu_jobs),
+                Stage("sdist-check", check_sdist, workers=cpu_jobs),
+            ],
+            queue_size=2 * max(config.jobs, cpu_jobs),
+        )
+
+        n_total = sum(map(len, self._files))
+        log.info(
+            "Downloading %d distinct dependencies (%d requirements in %d files) "
+            "using %d jobs (at most %d per host) and %d VCS jobs (at most %d per host)",
+            len(self._unique),
+            n_total,
+            len(self._files),
+            config.jobs,
+            config.jobs_per_host,
+            config.vcs_jobs,
+            config.vcs_jobs_per_host,
+        )
+
+        jobs = [
+            {"key": key, "req": req, "trusted_hosts": trusted_hosts}
+            for key, (req, trusted_hosts) in self._unique.items()
+        ]
+        if previous:
+            # Skip the index lookup and download of PyPI dependencies, the files are still
+            # verified. VCS and URL dependencies are not fetched again if their files exist.
+            for job in jobs:
+                recorded = previous.get(_get_state_key(job["key"]))
+                if recorded is not None and "info" in recorded and recorded["path"].is_file():
+                    job["info"] = {**recorded["info"], "path": recorded["path"]}
+            log.info(
+                "Reusing %d PyPI dependencies fetched by the previous run",
+                sum("info" in job for job in jobs),
+            )
+
+        with sdist_executor, vcs_executor:
+            for job in jobs:
+                if job["req"].kind == "vcs" and "info" not in job:
+                    vcs_futures[job["key"]] = vcs_executor.submit(fetch_vcs, job)
+            try:
+                results = pipeline.run(jobs)
+            finally:
+                # If the pipeline failed (or was interrupted), don't start any more fetches.
+                # Running fetches finish and remove their temporary directories.
+                vcs_cancelled.set()
+                vcs_executor.shutdown(cancel_futures=True)
+        self._downloads = {job["key"]: job["info"] for job in results}
+
+        if config.incremental:
+            self._remove_stale_downloads(previous)
+            self._save_state()
+
+        for entries in self._files:
+            for req, key, _ in entries:
+                download_info = self._downloads[key]
+                log.info(
+                    "Successfully downloaded %s to %s",
+                    req.download_line,
+                    download_info["path"].relative_to(self.workdir),
+                )
+
+                # If the raw component is not in the Nexus hoster instance, upload it there
+                # if req.kind in ("vcs", "url") and not download_info["have_raw_component"]:
+                #     log.debug(
+                #         "Uploading %r to %r as %r",
+                #         download_info["path"].name,
+                #         pip_raw_repo_name,
+                #         download_info["raw_component_name"],
+                #     )
+                #     dest_dir, filename = download_info["raw_component_name"].rsplit("/", 1)
+                #     upload_raw_package(
+                #         pip_raw_repo_name,
+                #         download_info["path"],
+                #         dest_dir,
+                #         filename,
+                #         is_request_repository=False,
+                #     )
+
+    def _get_inputs(self) -> dict[str, str]:
+        """Get the sha256 digests of the added requirements files, by their paths."""
+        return {path: file_digests(path, ["sha256"])["sha256"] for path in self._file_paths}
+
+    def _load_state(self) -> dict[tuple, dict]:
+        """
+        Load the downloads recorded by the previous incremental run, see _save_state.
+
+        :return: the downloads of the previous run by key (see _get_state_key), each a dict with
+            the "path" and, for PyPI dependencies, the download "info". Empty if there is no
+            usable state.
+        """
+        try:
+            state = json.loads(self._state_path.read_text())
+        except FileNotFoundError:
+            log.info("No previous fetch state in %s, fetching all dependencies", self._state_path)
+            return {}
+        except (OSError, ValueError) as e:
+            log.warning("Ignoring invalid fetch state %s: %s", self._state_path, e)
+            return {}
+
+        pip_deps_dir = (self.workdir / "deps" / "pip").resolve()
+        previous = {}
+        try:
+            if (
+                state["version"] != _get_cachitool_version()
+                or state.get("format") != _FETCH_STATE_FORMAT
+                or state["pypi_url"] != self.pypi_url
+            ):
+                log.info(
+                    "Ignoring fetch state %s, it was written by cachitool %s in format %s for %s",
+                    self._state_path,
+                    state["version"],
+                    state.get("format"),
+                    state["pypi_url"],
+                )
+                return {}
+
+            for dependency in state["dependencies"]:
+                recorded = {"path": self.workdir / dependency["path"]}
+                if not recorded["path"].resolve().is_relative_to(pip_deps_dir):
+                    log.warning(
+                        "Ignoring %s from the fetch state, not in deps/pip", recorded["path"]
+                    )
+                    continue
+                if "info" in dependency:
+                    recorded["info"] = dependency["info"]
+                previous[tuple(dependency["key"])] = recorded
+
+            inputs = state["inputs"]
+        except (KeyError, TypeError) as e:
+            log.warning("Ignoring invalid fetch state %s: %s", self._state_path, e)
+            return {}
+
+        current_inputs = self._get_inputs()
+        changed_inputs = sorted(
+            path
+            for path in inputs.keys() | current_inputs.keys()
+            if inputs.get(path) != current_inputs.get(path)
+        )
+        if changed_inputs:
+            log.info(
+                "Requirements files changed since the previous run: %s", ", ".join(changed_inputs)
+            )
+        else:
+            log.info("The requirements files did not change since the previous run")
+
+        return previous
+
+    def _save_state(self) -> None:
+        """
+        Record the inputs and the downloads of this run for the next incremental run.
+
+        The keys are stored without credentials (see _get_state_key). Only the download info of
+        PyPI dependencies is stored, the info of VCS and URL dependencies includes their URLs.
+        """
+        dependencies = []
+        for key, info in self._downloads.items():
+            dependency = {
+                "key": _get_state_key(key),
+                "path": str(info["path"].relative_to(self.workdir)),
+            }
+            if info["kind"] == "pypi":
+                # Don't trust the digests from the previous run, the files may have changed
+                # (the DigestCache knows them anyway)
+                dependency["info"] = {
+                    name: value for name, value in info.items() if name not in ("path", "digests")
+                }
+            dependencies.append(dependency)
+
+        state = {
+            "version": _get_cachitool_version(),
+            "format": _FETCH_STATE_FORMAT,
+            "pypi_url": self.pypi_url,
+            "inputs": self._get_inputs(),
+            "dependencies": dependencies,
+        }
+        with tempfile.NamedTemporaryFile("w", dir=self._state_path.parent, delete=False) as tmp:
+            json.dump(state, tmp)
+        os.replace(tmp.name, self._state_path)
+
+    def _remove_stale_downloads(self, previous: dict[tuple, dict]) -> None:
+        """
+        Log what changed since the previous run and remove the files that are not needed anymore.
+
+        Only the files recorded in the previous state are ever removed.
+
+        :param dict previous: the downloads of the previous run, see _load_state
+        """
+        current = {_get_state_key(key): info for key, info in self._downloads.items()}
+        added = current.keys() - previous.keys()
+        removed = previous.keys() - current.keys()
+
+        # A different version (or URL, git ref...) of the same package counts as a change
+        added_by_name = collections.defaultdict(list)
+        for key in sorted(added):
+            added_by_name[key[:2]].append(current[key]["path"].name)
+        removed_by_name = collections.defaultdict(list)
+        for key in sorted(removed):
+            removed_by_name[key[:2]].append(previous[key]["path"].name)
+
+        n_added = n_changed = n_removed = 0
+        for kind, name in sorted(added_by_name.keys() | removed_by_name.keys()):
+            new_files = ", ".join(added_by_name.get((kind, name), []))
+            old_files = ", ".join(removed_by_name.get((kind, name), []))
+            if new_files and old_files:
+                log.info("Changed %s dependency %s: %s -> %s", kind, name, old_files, new_files)
+                n_changed += 1
+            elif new_files:
+                log.info("Added %s dependency %s: %s", kind, name, new_files)
+                n_added += 1
+            else:
+                log.info("Removed %s dependency %s: %s", kind, name, old_files)
+                n_removed += 1
+
+        log.info(
+            "Dependencies since the previous run: %d added, %d changed, %d removed, %d unchanged",
+            n_added,
+            n_changed,
+            n_removed,
+            len(current.keys() & previous.keys()),
+        )
+
+        pip_deps_dir = self.workdir / "deps" / "pip"
+        needed = {info["path"] for info in current.values()}
+        for key in removed:
+            path = previous[key]["path"]
+            if path in needed or not path.is_file():
+                continue
+            log.info("Removing stale %s", path.relative_to(self.workdir))
+            path.unlink()
+            # Also remove the package directories that are now empty
+            parent = path.parent
+            while parent != pip_deps_dir and not any(parent.iterdir()):
+                parent.rmdir()
+                parent = parent.parent
+
+    def get_downloads(self, handle: int) -> list[dict]:
+        """
+        Get info about the downloaded packages for a file added to the plan.
+
+        :param int handle: the handle returned by add_requirements_file()
+        :return: see download_dependencies()
+        :rtype: list[dict]
+        """
+        if self._downloads is None:
+            raise RuntimeError("The download plan was not executed yet")
+        # Return copies, the caller may modify them (e.g. to mark dev dependencies)
+        return [dict(self._downloads[key]) for _, key, _ in self._files[handle]]
+
+
+def _requirement_key(req, trusted_hosts):
+    """
+    Get the key that identifies what will be downloaded for a requirement.
+
+    Requirements with the same key download the same file to the same path.
+
+    :param PipRequirement req: requirement from a requirements.txt file
+    :param set[str] trusted_hosts: trusted hosts from the requirements file
+    :rtype: tuple
+    """
+    name = _canonicalize_name(req.package)
+    if req.kind == "pypi":
+        return req.kind, name, _canonicalize_version(req.version_specs[0][1])
+    elif req.kind == "vcs":
+        git_info = extract_git_info(req.url)
+        return req.kind, name, git_info["url"], git_info["ref"]
+    else:
+        hash_spec = req.hashes[0] if req.hashes else req.qualifiers["cachito_hash"]
+        url = urllib.parse.urlparse(req.url)
+        insecure = _is_trusted_host(url, trusted_hosts)
+        return req.kind, name, req.url, hash_spec, insecure
+
+
 def download_dependencies(requirements_file: PipRequirementsFile, workdir: Path):
     """
     Download sdists (source distributions) of all dependencies in a requirements.txt file.
@@ -1258,92 +1935,73 @@ def download_dependencies(requirements_file: PipRequirementsFile, workdir: Path)
     were not already present. PyPI dependencies get cached automatically just by being
     downloaded from the right URL, see _download_pypi_package().
 
+    To download the dependencies of many files at once, use a DownloadPlan.
+
     :param PipRequirementsFile requirements_file: A requirements.txt file
     :param Path workdir: download the dependencies into deps/pip under this directory
     :return: Info about downloaded packages; all items will contain "kind" and "path" keys
         (and more based on kind, see _download_*_package functions for more details)
     :rtype: list[dict]
     """
-    options = _process_options(requirements_file.options)
-    trusted_hosts = set(options["trusted_hosts"])
+    plan = DownloadPlan(workdir)
+    handle = plan.add_requirements_file(requirements_file)
+    plan.execute()
+    return plan.get_downloads(handle)
 
-    if options["require_hashes"]:
-        log.info("Global --require-hashes option used, will require hashes")
-        require_hashes = True
-    elif any(req.hashes for req in requirements_file.requirements):
-        log.info("At least one dependency uses the --hash option, will require hashes")
-        require_hashes = True
-    else:
-        log.info(
-            "No hash options used, will not require hashes for non-HTTP(S) dependencies. "
-            "HTTP(S) dependencies always require hashes (use the #cachito_hash URL qualifier)."
-        )
-        require_hashes = False
 
-    _validate_requirements(requirements_file.requirements)
-    _validate_provided_hashes(requirements_file.requirements, require_hashes)
+def _download_requirement(req, pip_deps_dir, pypi_url, trusted_hosts, sdist=None):
+    """
+    Download a single requirement, dispatching to the _download_*_package function for its kind.
 
-    pip_deps_dir = workdir / "deps" / "pip"
-    pip_deps_dir.mkdir(parents=True, exist_ok=True)
+    :param PipRequirement req: requirement from a requirements.txt file
+    :param Path pip_deps_dir: The deps/pip directory in a Cachito request bundle
+    :param str pypi_url: URL of the PyPI server or a PyPI proxy
+    :param set[str] trusted_hosts: If host (or host:port) is trusted, do not verify SSL
+    :param dict sdist: for PyPI requirements, the sdist found by _find_pypi_sdist (if not
+        provided, it will be looked up)
+    :return: Info about the downloaded package, see download_dependencies return docs
+    :rtype: dict
+    """
+    log.info("Downloading %s", req.download_line)
 
-    pypi_url = "https://pypi.org/"
-    # TODO: will be useful
-    # pypi_url = config.pypi_proxy_url
-    # pypi_auth = ...
+    if req.kind == "pypi":
+        if sdist is None:
+            sdist = _find_pypi_sdist(req, pypi_url)
+        download_info = _download_pypi_sdist(
+            req, sdist, pip_deps_dir,  # pypi_auth
+        )
+    elif req.kind == "vcs":
+        download_info = _download_vcs_package(
+            req, pip_deps_dir,  # pip_raw_repo_name, nexus_auth
+        )
+    elif req.kind == "url":
+        download_info = _download_url_package(
+            req, pip_deps_dir, trusted_hosts,  # pip_raw_repo_name, nexus_auth
+        )
+    else:
+        # Should not happen
+        raise RuntimeError(f"Unexpected requirement kind: {req.kind!r}")
 
-    downloads = []
+    download_info["kind"] = req.kind
+    return download_info
 
-    for req in requirements_file.requirements:
-        log.info("Downloading %s", req.download_line)
 
-        if req.kind == "pypi":
-            download_info = _download_pypi_package(
-                req, pip_deps_dir, pypi_url,  # pypi_auth
-            )
-            check_metadata_in_sdist(download_info["path"])
-        elif req.kind == "vcs":
-            download_info = _download_vcs_package(
-                req, pip_deps_dir,  # pip_raw_repo_name, nexus_auth
-            )
-        elif req.kind == "url":
-            download_info = _download_url_package(
-                req, pip_deps_dir, trusted_hosts,  # pip_raw_repo_name, nexus_auth
-            )
-        else:
-            # Should not happen
-            raise RuntimeError(f"Unexpected requirement kind: {req.kind!r}")
-
-        log.info(
-            "Successfully downloaded %s to %s",
-            req.download_line,
-            download_info["path"].relative_to(workdir),
-        )
+def _requirement_host(req, pypi_url):
+    """
+    Get the host that a requirement will be downloaded from.
 
-        if require_hashes or req.kind == "url":
-            hashes = req.hashes or [req.qualifiers["cachito_hash"]]
-            _verify_hash(download_info["path"], hashes)
-
-        # If the raw component is not in the Nexus hoster instance, upload it there
-        # if req.kind in ("vcs", "url") and not download_info["have_raw_component"]:
-        #     log.debug(
-        #         "Uploading %r to %r as %r",
-        #         download_info["path"].name,
-        #         pip_raw_repo_name,
-        #         download_info["raw_component_name"],
-        #     )
-        #     dest_dir, filename = download_info["raw_component_name"].rsplit("/", 1)
-        #     upload_raw_package(
-        #         pip_raw_repo_name,
-        #         download_info["path"],
-        #         dest_dir,
-        #         filename,
-        #         is_request_repository=False,
-        #     )
-
-        download_info["kind"] = req.kind
-        downloads.append(download_info)
-
-    return downloads
+    :param PipRequirement req: requirement from a requirements.txt file
+    :param str pypi_url: URL of the PyPI server or a PyPI proxy
+    :return: the host (possibly with port) or None if not known
+    :rtype: str or None
+    """
+    if req.kind == "pypi":
+        return urllib.parse.urlparse(pypi_url).netloc.rpartition("@")[2]
+    elif req.kind == "vcs":
+        return extract_git_info(req.url)["host"]
+    elif req.kind == "url":
+        return urllib.parse.urlparse(req.url).netloc.rpartition("@")[2]
+    return None
 
 
 def _process_options(options):
@@ -1523,21 +2181,35 @@ def _download_pypi_package(requirement, pip_deps_dir, pypi_url, pypi_auth=None):
     :raises NetworkError: if PyPI query failed
     :raises InvalidRequestData: if sdists for the package is not found or yanked
     """
+    sdist = _find_pypi_sdist(requirement, pypi_url, pypi_auth)
+    return _download_pypi_sdist(requirement, sdist, pip_deps_dir, pypi_auth)
+
+
+def _find_pypi_sdist(requirement, pypi_url, pypi_auth=None):
+    """
+    Find the best sdist for a PyPI requirement in the package index.
+
+    :param PipRequirement requirement: PyPI requirement from a requirement.txt file
+    :param str pypi_url: URL of the PyPI server or a PyPI proxy
+    :param (None|requests.auth.AuthBase) pypi_auth: Authorization for the PyPI server/proxy
+    :return: sdist dict as returned by _process_package_links, with an absolute "url"
+    :raises NetworkError: if PyPI query failed
+    :raises InvalidRequestData: if sdists for the package is not found or yanked
+    """
     package = requirement.package
     version = requirement.version_specs[0][1]
 
-    # See https://www.python.org/dev/peps/pep-0503/
-    package_url = f"{pypi_url.rstrip('/')}/simple/{canonicalize_name(package)}/"
+    # See https://www.python.org/dev/peps/pep-0503/ and https://peps.python.org/pep-0691/
+    package_url = f"{pypi_url.rstrip('/')}/simple/{_canonicalize_name(package)}/"
     try:
-        pypi_resp = pkg_requests_session.get(package_url, auth=pypi_auth)
+        pypi_resp = get_pkg_requests_session().get(
+            package_url, auth=pypi_auth, headers={"Accept": SIMPLE_API_ACCEPT}
+        )
         pypi_resp.raise_for_status()
     except requests.RequestException as e:
         raise NetworkError(f"PyPI query failed: {e}")
 
-    html = bs4.BeautifulSoup(pypi_resp.text, features="html.parser")
-    # Find all anchors anywhere in the doc, the PEP does not specify where they should be
-    links = html.find_all("a")
-
+    links = _parse_simple_api_response(pypi_resp)
     sdists = _process_package_links(links, package, version)
     if not sdists:
         raise InvalidRequestData(f"No sdists found for package {package}=={version}")
@@ -1547,6 +2219,21 @@ def _download_pypi_package(requirement, pip_deps_dir, pypi_url, pypi_auth=None):
     if sdist.get("yanked", False):
         raise InvalidRequestData(f"All sdists for package {package}=={version} are yanked")
 
+    # url may or may not be relative
+    return {**sdist, "url": urllib.parse.urljoin(package_url, sdist["url"])}
+
+
+def _download_pypi_sdist(requirement, sdist, pip_deps_dir, pypi_auth=None):
+    """
+    Download an sdist found by _find_pypi_sdist.
+
+    :param PipRequirement requirement: PyPI requirement from a requirement.txt file
+    :param dict sdist: the sdist to download
+    :param Path pip_deps_dir: The deps/pip directory in a Cachito request bundle
+    :param (None|requests.auth.AuthBase) pypi_auth: Authorization for the PyPI server/proxy
+    :return: Dict with package name, version and download path
+    :raises NetworkError: if the download failed
+    """
     package_dir = pip_deps_dir / sdist["name"]
     package_dir.mkdir(exist_ok=True)
     download_path = package_dir / sdist["filename"]
@@ -1561,25 +2248,82 @@ def _download_pypi_package(requirement, pip_deps_dir, pypi_url, pypi_auth=None):
         log.info(f"{download_path.name} already downloaded")
         return info
 
-    # url may or may not be relative
-    sdist_url = urllib.parse.urljoin(package_url, sdist["url"])
-    general.download_binary_file(sdist_url, download_path, auth=pypi_auth)
+    info["digests"] = general.download_artifact(
+        sdist["url"],
+        download_path,
+        known_hashes=sdist["hashes"],
+        auth=pypi_auth,
+        # If the requirement has no hashes, at least check the ones provided by the index
+        expected_hashes=requirement.hashes or [f"{a}:{d}" for a, d in sdist["hashes"].items()],
+    )
     return info
 
 
+def _parse_simple_api_response(pypi_resp):
+    """
+    Parse the list of files from a Simple Repository API response.
+
+    Use the PEP 691 JSON format if the server supports it, otherwise fall back to parsing
+    anchors from the PEP 503 HTML page.
+
+    :param requests.Response pypi_resp: Response for the /simple/<name>/ page
+    :return: List of dicts with filename, url, yanked, size and hashes keys (size is None
+        if the server does not provide it)
+    :raises NetworkError: if the JSON response is not valid
+    """
+    content_type, _, _ = pypi_resp.headers.get("Content-Type", "").partition(";")
+    if content_type.strip() == SIMPLE_API_JSON:
+        try:
+            files = pypi_resp.json()["files"]
+            return [
+                {
+                    "filename": file["filename"],
+                    "url": file["url"],
+                    # Either a bool or a (non-empty) string with the reason for yanking
+                    "yanked": bool(file.get("yanked", False)),
+                    "size": file.get("size"),
+                    "hashes": file.get("hashes", {}),
+                }
+                for file in files
+            ]
+        except (ValueError, KeyError, TypeError) as e:
+            raise NetworkError(f"PyPI query returned an invalid JSON response: {e!r}")
+
+    import bs4  # slow to import and only needed for indexes that do not support JSON
+
+    html = bs4.BeautifulSoup(pypi_resp.text, features="html.parser")
+    links = []
+    # Find all anchors anywhere in the doc, the PEP does not specify where they should be
+    for anchor in html.find_all("a"):
+        url = anchor.get("href", "")
+        # The URL fragment may contain a hash of the file, e.g. #sha256=...
+        hashname, _, hashvalue = urllib.parse.urlparse(url).fragment.partition("=")
+        links.append(
+            {
+                "filename": anchor.text,
+                "url": url,
+                # https://www.python.org/dev/peps/pep-0592/
+                "yanked": anchor.get("data-yanked") is not None,
+                "size": None,
+                "hashes": {hashname: hashvalue} if hashvalue else {},
+            }
+        )
+    return links
+
+
 def _process_package_links(links, name, version):
     """
     Process links to Python packages.
 
     Pick out sdists at the specified version, return metadata about found sdists.
 
-    :param Iterable links: Iterable of html anchor elements
+    :param Iterable links: Iterable of file dicts, see _parse_simple_api_response
     :param str name: Package name
     :param str version: Package version
     :return: List of dicts with processed metadata
     """
-    canonical_name = canonicalize_name(name)
-    canonical_version = canonicalize_version(version)
+    canonical_name = _canonicalize_name(name)
+    canonical_version = _canonicalize_version(version)
 
     # When matching package name, use a regex that will match any non-canonical
     # variation of the canonical name (it also needs to be case-insensitive).
@@ -1594,22 +2338,23 @@ def _process_package_links(links, name, version):
     sdists = []
 
     for link in links:
-        match = sdist_re.match(link.text)
+        match = sdist_re.match(link["filename"])
         if not match:
             continue
 
         name, version = match.groups()
-        if canonical_version != canonicalize_version(version):
+        if canonical_version != _canonicalize_version(version):
             continue
 
         sdists.append(
             {
                 "name": name,
                 "version": version,
-                "filename": link.text,
-                "url": link.get("href"),
-                # https://www.python.org/dev/peps/pep-0592/
-                "yanked": link.get("data-yanked") is not None,
+                "filename": link["filename"],
+                "url": link["url"],
+                "yanked": link["yanked"],
+                "size": link["size"],
+                "hashes": link["hashes"],
             }
         )
 
@@ -1621,14 +2366,18 @@ def _sdist_preference(sdist_pkg):
     Compute preference for a sdist package, can be used to sort in ascending order.
 
     Prefer files that are not yanked over ones that are.
-    Within the same category (yanked vs. not), prefer .tar.gz > .zip > anything else.
+    Within the same category (yanked vs. not), prefer smaller files (if the index reports
+    the size), then .tar.gz > .zip > anything else.
 
-    :param dict sdist_pkg: An item of the "urls" array in a PyPI response
-    :return: Tuple of integers to use as sorting key
+    :param dict sdist_pkg: An sdist dict as returned by _process_package_links
+    :return: Tuple of numbers to use as sorting key
     """
     # Higher number = higher preference
     yanked_pref = 0 if sdist_pkg.get("yanked", False) else 1
 
+    size = sdist_pkg.get("size")
+    size_pref = -size if size is not None else float("-inf")
+
     filename = sdist_pkg["filename"]
     if filename.endswith(".tar.gz"):
         filetype_pref = 2
@@ -1637,7 +2386,7 @@ def _sdist_preference(sdist_pkg):
     else:
         filetype_pref = 0
 
-    return yanked_pref, filetype_pref
+    return yanked_pref, size_pref, filetype_pref
 
 
 def _download_vcs_package(requirement, pip_deps_dir):
@@ -1688,6 +2437,8 @@ def _download_vcs_package(requirement, pip_deps_dir):
 
     # if not have_raw_component:
         # log.debug("Raw component not found, will fetch from git")
+    from cachitool.scm import Git  # imports git, which is slow to import
+
     repo = Git(git_info["url"], ref)
     repo.fetch_source(download_path, gitsubmodule=False)
     # Copy downloaded archive to expected download path
@@ -1750,22 +2501,36 @@ def _download_url_package(requirement, pip_deps_dir, trusted_hosts):
     # if not have_raw_component:
         # log.debug("Raw component not found, will download from %r", requirement.url)
 
-    if url.hostname in trusted_hosts:
-        log.debug("Disabling SSL verification, %s is a --trusted-host", url.hostname)
-        insecure = True
-    elif url.port is not None and f"{url.hostname}:{url.port}" in trusted_hosts:
-        log.debug(
-            "Disabling SSL verification, %s:%s is a --trusted-host", url.hostname, url.port
-        )
-        insecure = True
-    else:
-        insecure = False
-
-    general.download_binary_file(requirement.url, download_path, insecure=insecure)
+    insecure = _is_trusted_host(url, trusted_hosts)
+    if insecure:
+        log.debug("Disabling SSL verification, %s is a --trusted-host", url.netloc)
+
+    algorithm, _, digest = hash_spec.partition(":")
+    info["digests"] = general.download_artifact(
+        requirement.url,
+        download_path,
+        known_hashes={algorithm: digest},
+        insecure=insecure,
+        expected_hashes=[hash_spec],
+    )
 
     return info
 
 
+def _is_trusted_host(parsed_url, trusted_hosts):
+    """
+    Check if the host (or host:port) of a URL is trusted, i.e. SSL should not be verified.
+
+    :param urllib.parse.ParseResult parsed_url: A parsed URL
+    :param set[str] trusted_hosts: Hosts from --trusted-host options
+    :rtype: bool
+    """
+    if parsed_url.hostname in trusted_hosts:
+        return True
+    host_port = f"{parsed_url.hostname}:{parsed_url.port}"
+    return parsed_url.port is not None and host_port in trusted_hosts
+
+
 def _add_cachito_hash_to_url(parsed_url, hash_spec):
     """
     Add the #cachito_hash fragment to URL.
@@ -1781,21 +2546,37 @@ def _add_cachito_hash_to_url(parsed_url, hash_spec):
     return parsed_url._replace(fragment=new_fragment).geturl()
 
 
-def _verify_hash(download_path, hashes):
+def _verify_hash(download_path, hashes, digests=None):
     """
     Check that downloaded archive verifies against at least one of the provided hashes.
 
     :param Path download_path: Path to downloaded file
     :param list[str] hashes: All provided hashes for requirement
+    :param dict digests: Already computed hex digests of the file (e.g. while downloading),
+        mapping of algorithm to digest. Algorithms that are missing will be computed.
     :raise InvalidChecksum: If computed hash does not match any of the provided hashes
     """
     log.info(f"Verifying checksum of {download_path.name}")
 
+    # Compute all the missing digests in a single pass over the file
+    digests = dict(digests or {})
+    missing = set()
+    for hash_spec in hashes:
+        algorithm, _, _ = hash_spec.partition(":")
+        if algorithm not in digests and algorithm in hashlib.algorithms_available:
+            missing.add(algorithm)
+    if missing:
+        digests.update(file_digests(download_path, missing))
+
     for hash_spec in hashes:
         algorithm, _, digest = hash_spec.partition(":")
         checksum_info = ChecksumInfo(algorithm, digest)
         try:
-            verify_checksum(str(download_path), checksum_info)
+            if algorithm in digests:
+                verify_digest(download_path.name, digests[algorithm], checksum_info)
+            else:
+                # Reports the unknown algorithm
+                verify_checksum(str(download_path), checksum_info)
             log.info(f"Checksum of {download_path.name} matches: {algorithm}:{digest}")
             return
         except InvalidChecksum as e:
@@ -1912,23 +2693,36 @@ def get_index_url(nexus_pypi_hosted_repo_url, username, password):
     return simple_api_url
 
 
-def _download_from_requirement_files(files, workdir: Path):
+def _add_requirement_files(plan, files):
     """
-    Download dependencies listed in the requirement files.
+    Add the requirement files to a download plan.
 
+    :param DownloadPlan plan: the plan to add the files to
     :param list files: list of str, each representing the absolute path of a pip requirement file
-    :param Path workdir: download the dependencies into deps/pip under this directory
-    :return: Info about downloaded packages; see download_dependencies return docs for further
-        reference
-    :rtype: list[dict]
+    :return: the parsed files and their handles for DownloadPlan.get_downloads()
+    :rtype: tuple[list[PipRequirementsFile], list[int]]
     :raises FileAccessError: If requirement file does not exist
     """
-    requirements = []
+    requirements_files = []
+    handles = []
     for req_file in files:
         if not os.path.exists(req_file):
             raise FileAccessError(f"Following requirement file has an invalid path: {req_file}")
-        requirements.extend(download_dependencies(PipRequirementsFile(req_file), workdir))
-    return requirements
+        requirements_file = load_requirements_file(req_file)
+        requirements_files.append(requirements_file)
+        handles.append(plan.add_requirements_file(requirements_file))
+    return requirements_files, handles
+
+
+def _get_planned_downloads(plan, handles):
+    """
+    Get the downloads for requirement files added to an executed download plan.
+
+    :return: Info about downloaded packages; see download_dependencies return docs for further
+        reference
+    :rtype: list[dict]
+    """
+    return [download for handle in handles for download in plan.get_downloads(handle)]
 
 
 def _default_requirement_file_list(path, devel=False):
@@ -2031,6 +2825,8 @@ def resolve_pip(path, workdir: Path, requirement_files=None, build_requirement_f
         ``dependencies`` which is a list of dicts representing the package Dependencies
         ``requirements`` which is a list of str with the absolute paths for the requirement files
             belonging to the package
+        ``requirements_files`` which is a list of the parsed PipRequirementsFile objects, in the
+            same order as ``requirements``
     :rtype: dict
     :raises InvalidRequestData: if the package is not cachito-pip compatible
     """
@@ -2041,21 +2837,79 @@ def resolve_pip(path, workdir: Path, requirement_files=None, build_requirement_f
     #     log.exception("The requested package is not pip compatible")
     #     raise
 
-    # This could be an empty list
-    if requirement_files is None:
-        requirement_files = _default_requirement_file_list(path)
-    else:
-        requirement_files = _get_absolute_pkg_file_paths(path, requirement_files)
+    return resolve_pip_packages(
+        [(path, requirement_files, build_requirement_files)], workdir
+    )[0]
 
-    # This could be an empty list
-    if build_requirement_files is None:
-        build_requirement_files = _default_requirement_file_list(path, devel=True)
-    else:
-        build_requirement_files = _get_absolute_pkg_file_paths(path, build_requirement_files)
 
-    requires = _download_from_requirement_files(requirement_files, workdir)
-    buildrequires = _download_from_requirement_files(build_requirement_files, workdir)
+def resolve_pip_packages(packages, workdir: Path):
+    """
+    Resolve and fetch pip dependencies for many packages at once.
+
+    Requirements from all the packages and their requirement files are collected first, so
+    that each distinct dependency is fetched exactly once, even if many packages need it.
+
+    :param list packages: list of (path, requirement_files, build_requirement_files) tuples,
+        see resolve_pip for the meaning of each item
+    :param Path workdir: download the dependencies into deps/pip under this directory
+    :return: list of dicts, one for each package, see resolve_pip
+    :rtype: list[dict]
+    """
+    plan = DownloadPlan(workdir)
+    planned = []
+
+    for path, requirement_files, build_requirement_files in packages:
+        # This could be an empty list
+        if requirement_files is None:
+            requirement_files = _default_requirement_file_list(path)
+        else:
+            requirement_files = _get_absolute_pkg_file_paths(path, requirement_files)
+
+        # This could be an empty list
+        if build_requirement_files is None:
+            build_requirement_files = _default_requirement_file_list(path, devel=True)
+        else:
+            build_requirement_files = _get_absolute_pkg_file_paths(path, build_requirement_files)
+
+        planned.append(
+            (
+                requirement_files,
+                build_requirement_files,
+                *_add_requirement_files(plan, requirement_files),
+                *_add_requirement_files(plan, build_requirement_files),
+            )
+        )
+
+    plan.execute()
+
+    return [
+        _make_resolve_output(
+            requirement_files,
+            build_requirement_files,
+            _get_planned_downloads(plan, requires_handles),
+            _get_planned_downloads(plan, buildrequires_handles),
+            [*parsed_requirement_files, *parsed_build_requirement_files],
+        )
+        for (
+            requirement_files,
+            build_requirement_files,
+            parsed_requirement_files,
+            requires_handles,
+            parsed_build_requirement_files,
+            buildrequires_handles,
+        ) in planned
+    ]
+
 
+def _make_resolve_output(
+    requirement_files, build_requirement_files, requires, buildrequires, parsed_files
+):
+    """Turn info about downloaded packages into the return value of resolve_pip.
+
+    The parsed_files (PipRequirementsFile objects, in the same order as the requirement_files
+    followed by build_requirement_files) are returned as well, so that the requirements files
+    don't need to be parsed again when they are rewritten for the local index.
+    """
     # Mark all build dependencies as Cachito dev dependencies
     for dependency in buildrequires:
         dependency["dev"] = True
@@ -2098,6 +2952,7 @@ def resolve_pip(path, workdir: Path, requirement_files=None, build_requirement_f
         },
         "dependencies": dependencies,
         "requirements": [*requirement_files, *build_requirement_files],
+        "requirements_files": parsed_files,
     }
 
 
@@ -2142,15 +2997,27 @@ def get_raw_component_name(requirement):
     return raw_component_name
 
 
-def _iter_zip_file(file_path: Path):
+def _read_pkg_info_from_zip(file_path: Path) -> bytes | None:
+    # The member names are in the central directory, no need to decompress anything else
     with zipfile.ZipFile(file_path, "r") as zf:
-        yield from zf.namelist()
+        for name in zf.namelist():
+            if is_pkg_info_dir(name):
+                return zf.read(name)
+    return None
 
 
-def _iter_tar_file(file_path: Path):
-    with tarfile.open(file_path, "r") as tar:
-        for member in tar:
-            yield member.name
+def _read_pkg_info_from_tar(file_path: Path) -> bytes | None:
+    with open(file_path, "rb") as f:
+        if file_path.name.endswith(COMPRESSED_TAR_EXT):
+            tar = tarfile.open(fileobj=io.BufferedReader(LZWReader(f)), mode="r|")
+        else:
+            tar = tarfile.open(fileobj=f, mode="r|*")
+        # Stream the archive and stop at PKG-INFO, it is usually one of the first members
+        with tar:
+            for member in tar:
+                if member.isfile() and is_pkg_info_dir(member.name):
+                    return tar.extractfile(member).read()
+    return None
 
 
 def is_pkg_info_dir(path: str) -> bool:
@@ -2162,24 +3029,21 @@ def is_pkg_info_dir(path: str) -> bool:
     :return: True if it is, otherwise False is returned.
     :rtype: bool
     """
-    parts = os.path.split(path)
+    parts = PurePosixPath(path.removeprefix("./")).parts
     return len(parts) == 2 and parts[1] == "PKG-INFO"
 
 
-def check_metadata_in_sdist(sdist_path: Path):
-    """Check if a downloaded sdist package has metadata.
+def _read_sdist_metadata(sdist_path: Path) -> dict[str, str] | None:
+    """
+    Read the Name and Version from the PKG-INFO file of an sdist.
 
-    :param sdist_path: the path of a sdist package file.
-    :type sdist_path: pathlib.Path
-    :raise ValidationError: if the sdist cannot be validated.
+    :return: dict with "name" and "version" (None if missing), or None if there is no PKG-INFO
+    :raise ValidationError: if the sdist cannot be read
     """
     if sdist_path.name.endswith(ZIP_FILE_EXT):
-        files_iter = _iter_zip_file(sdist_path)
-    elif sdist_path.name.endswith(COMPRESSED_TAR_EXT):
-        log.warning("Skip checking metadata from compressed sdist %s", sdist_path.name)
-        return
+        read_pkg_info = _read_pkg_info_from_zip
     elif any(map(sdist_path.name.endswith, SDIST_FILE_EXTENSIONS)):
-        files_iter = _iter_tar_file(sdist_path)
+        read_pkg_info = _read_pkg_info_from_tar
     else:
         raise ValidationError(
             f"Cannot check metadata from {sdist_path}, "
@@ -2187,14 +3051,71 @@ def check_metadata_in_sdist(sdist_path: Path):
         )
 
     try:
-        if not any(map(is_pkg_info_dir, files_iter)):
-            raise ValidationError(
-                f"{sdist_path.name} does not include metadata (there is no PKG-INFO file). "
-                f"It is not a valid sdist and cannot be downloaded from PyPI. "
-                f"Consider editing your requirements file to download the package from git "
-                f"or a direct download URL instead."
-            )
-    except tarfile.ReadError as e:
+        pkg_info = read_pkg_info(sdist_path)
+    except (tarfile.TarError, EOFError, zlib.error, lzma.LZMAError, gzip.BadGzipFile) as e:
         raise ValidationError(f"Cannot open {sdist_path} as a Tar file. Error: {str(e)}")
+    except LZWError as e:
+        raise ValidationError(f"Cannot decompress {sdist_path}. Error: {str(e)}")
     except zipfile.BadZipFile as e:
         raise ValidationError(f"Cannot open {sdist_path} as a Zip file. Error: {str(e)}")
+
+    if pkg_info is None:
+        return None
+    headers = email.parser.BytesHeaderParser().parsebytes(pkg_info)
+    return {"name": headers.get("Name"), "version": headers.get("Version")}
+
+
+def _get_sdist_metadata(sdist_path: Path) -> dict[str, str] | None:
+    """Get the metadata of an sdist (see _read_sdist_metadata), cached by the sdist digest."""
+    cache_dir = get_config().cache_dir
+    if cache_dir is None:
+        return _read_sdist_metadata(sdist_path)
+
+    digest = file_digests(sdist_path, ["sha256"])["sha256"]
+    cache_path = cache_dir.sdist_metadata / digest[:2] / f"{digest}.json"
+    try:
+        return json.loads(cache_path.read_text())["metadata"]
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError, KeyError) as e:
+        log.warning("Ignoring invalid sdist metadata cache entry %s: %s", cache_path, e)
+
+    metadata = _read_sdist_metadata(sdist_path)
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.NamedTemporaryFile("w", dir=cache_path.parent, delete=False) as tmp:
+        json.dump({"metadata": metadata}, tmp)
+    os.replace(tmp.name, cache_path)
+    return metadata
+
+
+def check_metadata_in_sdist(
+    sdist_path: Path, name: Optional[str] = None, version: Optional[str] = None
+):
+    """Check if a downloaded sdist package has metadata.
+
+    :param sdist_path: the path of a sdist package file.
+    :type sdist_path: pathlib.Path
+    :param str name: if set, the Name in the metadata must match this package name.
+    :param str version: if set, the Version in the metadata must match this version.
+    :raise ValidationError: if the sdist cannot be validated.
+    """
+    metadata = _get_sdist_metadata(sdist_path)
+    if metadata is None:
+        raise ValidationError(
+            f"{sdist_path.name} does not include metadata (there is no PKG-INFO file). "
+            f"It is not a valid sdist and cannot be downloaded from PyPI. "
+            f"Consider editing your requirements file to download the package from git "
+            f"or a direct download URL instead."
+        )
+
+    sdist_name, sdist_version = metadata["name"], metadata["version"]
+    if name and sdist_name and _canonicalize_name(sdist_name) != _canonicalize_name(name):
+        raise ValidationError(f"{sdist_path.name} is an sdist of {sdist_name}, expected {name}")
+    if (
+        version
+        and sdist_version
+        and _canonicalize_version(sdist_version) != _canonicalize_version(version)
+    ):
+        raise ValidationError(
+            f"{sdist_path.name} is an sdist of version {sdist_version}, expected {version}"
+        )
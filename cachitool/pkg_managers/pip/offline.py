@@ -1,12 +1,10 @@
-import filecmp
 import io
 import logging
 import os.path
 from pathlib import Path
 from typing import Iterable
 
-import piprepo.models
-
+from cachitool.checksum import file_digests
 from cachitool.errors import CachitoError
 from cachitool.models.output import PipResolvedDep
 from cachitool.pkg_managers.pip.fetch import PipRequirementsFile, get_raw_component_name
@@ -15,13 +13,17 @@ from cachitool.pkg_managers.pip.fetch import PipRequirementsFile, get_raw_compon
 log = logging.getLogger(__name__)
 
 
-def sync_repo(pip_deps: Iterable[PipResolvedDep], repo_dir: Path) -> tuple[Path, Path]:
+def sync_repo(
+    pip_deps: Iterable[PipResolvedDep], repo_dir: Path, prune: bool = False
+) -> tuple[Path, Path]:
     """Symlink downloaded dependencies to repo_dir to be used as a package source via --find-links.
 
     External dependencies will be symlinked to repo_dir/"external"/* and will not be found using
     --find-links (pip doesn't support find-links for those) . They need be replaced with file://
     urls in requirements files.
 
+    :param prune: also remove the broken symlinks to dependencies that are not in pip_deps
+        (anymore), i.e. those whose files were removed as stale
     :return:
         absolute Path to repo_dir
         absolute Path to dir with external deps
@@ -30,6 +32,7 @@ def sync_repo(pip_deps: Iterable[PipResolvedDep], repo_dir: Path) -> tuple[Path,
     external_dir = repo_dir / "external"
 
     repo_dir.mkdir(parents=True, exist_ok=True)
+    repo_files = set()
 
     for dep in pip_deps:
         dep_file = dep.downloaded_path
@@ -38,32 +41,52 @@ def sync_repo(pip_deps: Iterable[PipResolvedDep], repo_dir: Path) -> tuple[Path,
             external_dir.mkdir(exist_ok=True)
         else:
             repo_file = repo_dir / dep_file.name
+        repo_files.add(repo_file)
 
         if not repo_file.exists():
             # note: relpath will usually contain ../ and will break if either of the two dirs moves
             relpath = os.path.relpath(dep_file, start=repo_file.parent)
             repo_file.symlink_to(relpath)
-        elif not filecmp.cmp(dep_file, repo_file):
+        elif not _same_content(dep_file, repo_file):
             msg = (
                 f"{repo_file.name} already exists in the local index. "
                 f"{dep_file} has the same name but different content!"
             )
             raise CachitoError(msg)
 
+    if prune:
+        for repo_file in [*repo_dir.iterdir(), *_iterdir_if_exists(external_dir)]:
+            if repo_file.is_symlink() and not repo_file.exists() and repo_file not in repo_files:
+                log.info("Removing stale %s from the local index", repo_file.name)
+                repo_file.unlink()
+
     return repo_dir, external_dir
 
 
-def update_req_file(req_file_path: Path, external_deps_dir: Path) -> str | None:
+def _iterdir_if_exists(path: Path) -> Iterable[Path]:
+    return path.iterdir() if path.is_dir() else []
+
+
+def _same_content(path_a: Path, path_b: Path) -> bool:
+    if os.path.samefile(path_a, path_b):
+        return True
+    # Digests are usually cached (see DigestCache), so this does not need to read the files
+    return file_digests(path_a, ["sha256"]) == file_digests(path_b, ["sha256"])
+
+
+def update_req_file(
+    original_requirement_file: PipRequirementsFile, external_deps_dir: Path
+) -> str | None:
     """
     Modify pip requirement file. Return content of updated file (if updates needed) or None.
 
     Generates and returns a configuration file representing a custom pip requirement file where the
     original URL and VCS entries are replaced with entries pointing to entries in the local index.
 
-    :param str req_file_path: path to the requirement file
+    :param PipRequirementsFile original_requirement_file: the requirement file, as parsed when
+        fetching the dependencies
     :param Path external_deps_dir: path to the external dir in the local index
     """
-    original_requirement_file = PipRequirementsFile(req_file_path)
     external_deps_dir = external_deps_dir.resolve()
 
     cachito_requirements = []
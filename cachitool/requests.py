@@ -1,10 +1,26 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
+import hashlib
+import json
 import logging
+import os
+import re
+import tempfile
+import threading
+import time
+import urllib.parse
+import weakref
+from pathlib import Path
 
 import requests
 # import requests_kerberos
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+from urllib3.exceptions import TimeoutError as Urllib3TimeoutError
 from urllib3.util.retry import Retry
 
+from cachitool.concurrency import AdaptiveLimit, TokenBucket
+from cachitool.config import get_config
+
 # from cachito.workers.config import get_worker_config
 
 log = logging.getLogger(__name__)
@@ -21,16 +37,337 @@ DEFAULT_RETRY_OPTIONS = {
     "read": 5,
     "connect": 5,
     "backoff_factor": 1.3,
-    "status_forcelist": (500, 502, 503, 504),
+    "status_forcelist": (429, 500, 502, 503, 504),
 }
+# Responses with these statuses mean that the server is overloaded
+THROTTLING_STATUSES = frozenset({429, 503})
+# Maximum average number of requests per second to a host that got overloaded (unless the
+# requests_per_host config sets a limit for all hosts), and the maximum burst
+HOST_REQUEST_RATE = 10.0
+HOST_REQUEST_BURST = 10
+# How long to remember that a URL returned 404 (in seconds)
+NEGATIVE_CACHE_TTL = 300
+# Headers that describe the raw body, which no longer apply to cached (decoded) content
+_RAW_BODY_HEADERS = frozenset({"content-encoding", "content-length", "transfer-encoding"})
+_MAX_AGE = re.compile(r"(?:^|,)\s*max-age\s*=\s*\"?(\d+)\"?", re.IGNORECASE)
+
+
+class HTTPCache:
+    """
+    Cache responses to GET requests on disk, revalidate them using conditional requests.
+
+    Each entry is a single file: a JSON line with the response metadata followed by the body.
+    Responses with status 200 are fresh for as long as Cache-Control max-age allows, after that
+    they get revalidated using If-None-Match (ETag) and If-Modified-Since (Last-Modified).
+    Responses with status 404 are fresh for NEGATIVE_CACHE_TTL seconds.
+    """
+
+    def __init__(self, cache_dir: Path):
+        """
+        Initialize an HTTPCache.
+
+        :param Path cache_dir: store cached responses in this directory
+        """
+        self.cache_dir = cache_dir
+
+    def _entry_path(self, request: requests.PreparedRequest) -> Path:
+        # Responses to the same URL may differ based on the Accept header (e.g. PEP 691)
+        key_data = f"{request.url}\n{request.headers.get('Accept', '')}"
+        key = hashlib.sha256(key_data.encode()).hexdigest()
+        return self.cache_dir / key[:2] / key
+
+    def _load(self, path: Path) -> tuple[dict, bytes] | None:
+        try:
+            with path.open("rb") as f:
+                metadata = json.loads(f.readline())
+                body = f.read()
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            log.warning("Ignoring invalid HTTP cache entry %s: %s", path, e)
+            return None
+        return metadata, body
+
+    def _store(self, path: Path, metadata: dict, body: bytes) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Write to a temporary file and rename, other processes may be reading the entry
+        with tempfile.NamedTemporaryFile("wb", dir=path.parent, delete=False) as tmp:
+            tmp.write(json.dumps(metadata).encode())
+            tmp.write(b"\n")
+            tmp.write(body)
+        os.replace(tmp.name, path)
+
+    def _is_fresh(self, metadata: dict) -> bool:
+        age = time.time() - metadata["stored_at"]
+        if metadata["status"] == 404:
+            return age < NEGATIVE_CACHE_TTL
+
+        headers = CaseInsensitiveDict(metadata["headers"])
+        cache_control = headers.get("Cache-Control", "")
+        if "no-cache" in cache_control.lower():
+            return False
+        match = _MAX_AGE.search(cache_control)
+        return match is not None and age < int(match.group(1))
+
+    def _make_response(
+        self, request: requests.PreparedRequest, metadata: dict, body: bytes
+    ) -> requests.Response:
+        response = requests.Response()
+        response.status_code = metadata["status"]
+        response.reason = metadata["reason"]
+        response.headers = CaseInsensitiveDict(metadata["headers"])
+        response.encoding = get_encoding_from_headers(response.headers)
+        response.url = request.url
+        response.request = request
+        response._content = body
+        return response
+
+    def send(self, request: requests.PreparedRequest, send_fn) -> requests.Response:
+        """
+        Send the request unless a fresh response is cached, update the cache.
+
+        :param requests.PreparedRequest request: the request to send
+        :param send_fn: function that sends a PreparedRequest and returns a Response
+        :return: the (possibly cached) response
+        """
+        path = self._entry_path(request)
+        cached = self._load(path)
+
+        if cached is not None:
+            metadata, body = cached
+            if self._is_fresh(metadata):
+                log.debug("Using cached response for %s", request.url)
+                return self._make_response(request, metadata, body)
+
+            headers = CaseInsensitiveDict(metadata["headers"])
+            if metadata["status"] == 200:
+                if etag := headers.get("ETag"):
+                    request.headers["If-None-Match"] = etag
+                if last_modified := headers.get("Last-Modified"):
+                    request.headers["If-Modified-Since"] = last_modified
+
+        response = send_fn(request)
+
+        if response.status_code == 304 and cached is not None:
+            log.debug("Cached response for %s is still valid", request.url)
+            metadata, body = cached
+            response.close()
+            # A 304 response carries updated caching headers (Cache-Control, ETag, ...)
+            metadata["headers"].update(
+                (name, value)
+                for name, value in response.headers.items()
+                if name.lower() not in _RAW_BODY_HEADERS
+            )
+            metadata["stored_at"] = time.time()
+            self._store(path, metadata, body)
+            return self._make_response(request, metadata, body)
+
+        cache_control = response.headers.get("Cache-Control", "").lower()
+        if response.status_code in (200, 404) and "no-store" not in cache_control:
+            metadata = {
+                "status": response.status_code,
+                "reason": response.reason,
+                "headers": {
+                    name: value
+                    for name, value in response.headers.items()
+                    if name.lower() not in _RAW_BODY_HEADERS
+                },
+                "stored_at": time.time(),
+            }
+            self._store(path, metadata, response.content)
+
+        return response
+
+
+class CachingHTTPAdapter(requests.adapters.HTTPAdapter):
+    """HTTPAdapter that caches responses to non-streamed GET requests in the cache_dir."""
+
+    def send(self, request, stream=False, **kwargs):
+        """Send the request, unless the response is cached. See HTTPCache.send."""
+        cache_dir = get_config().cache_dir
+        if cache_dir is None or stream or request.method != "GET":
+            return super().send(request, stream=stream, **kwargs)
+
+        def send_fn(request):
+            return super(CachingHTTPAdapter, self).send(request, stream=stream, **kwargs)
+
+        return HTTPCache(cache_dir.http).send(request, send_fn)
+
+
+class HostThrottle:
+    """
+    Limit the requests to a single host.
+
+    The number of concurrent requests is an AdaptiveLimit (up to jobs_per_host), it shrinks when
+    the host responds with a THROTTLING_STATUS or times out and recovers as requests succeed.
+    The request rate is limited by a TokenBucket, which also pauses all requests to the host
+    for as long as the host asks to (Retry-After). Without a configured requests_per_host, the
+    rate is only limited (to HOST_REQUEST_RATE) once the host gets overloaded.
+    """
+
+    def __init__(self, host: str, max_concurrency: int, max_rate: float | None = None):
+        """
+        Initialize a HostThrottle.
+
+        :param str host: the name of the host (for logging)
+        :param int max_concurrency: maximum number of concurrent requests
+        :param float max_rate: maximum average number of requests per second, None means
+            no limit until the host gets overloaded
+        """
+        self.host = host
+        self.concurrency = AdaptiveLimit(max_concurrency)
+        self.rate = None if max_rate is None else TokenBucket(max_rate, max(max_rate, 1.0))
+        self._lock = threading.Lock()
+
+    def acquire_rate(self) -> None:
+        """Wait until the rate limit (if any) allows another request."""
+        rate = self.rate
+        if rate is not None:
+            rate.acquire()
+
+    def throttled(self, retry_after: float | None = None) -> None:
+        """
+        Report that the host is overloaded.
+
+        :param float retry_after: the number of seconds the host asked us to wait (if any)
+        """
+        if self.concurrency.decrease():
+            log.info(
+                "%s is overloaded, reducing concurrent requests to %d",
+                self.host,
+                self.concurrency.limit,
+            )
+        with self._lock:
+            if self.rate is None:
+                log.info(
+                    "%s is overloaded, limiting requests to %.0f per second",
+                    self.host,
+                    HOST_REQUEST_RATE,
+                )
+                self.rate = TokenBucket(HOST_REQUEST_RATE, HOST_REQUEST_BURST)
+        if retry_after:
+            log.info("%s asked to retry after %.1f seconds", self.host, retry_after)
+            self.rate.pause(retry_after)
+
+
+_host_throttles: dict[str, HostThrottle] = {}
+_host_throttles_lock = threading.Lock()
+
+
+def get_host_throttle(host: str) -> HostThrottle:
+    """Get the HostThrottle for a host, shared by all sessions."""
+    with _host_throttles_lock:
+        throttle = _host_throttles.get(host)
+        if throttle is None:
+            config = get_config()
+            throttle = HostThrottle(host, config.jobs_per_host, config.requests_per_host)
+            _host_throttles[host] = throttle
+        return throttle
+
+
+class ThrottlingRetry(Retry):
+    """Retry that reports overloaded hosts (see THROTTLING_STATUSES) to their HostThrottle."""
+
+    def increment(
+        self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None
+    ):
+        """Report throttling responses and timeouts, then see Retry.increment."""
+        if _pool is not None:
+            if response is not None and response.status in THROTTLING_STATUSES:
+                get_host_throttle(_pool.host).throttled(self.get_retry_after(response))
+            elif isinstance(error, Urllib3TimeoutError):
+                get_host_throttle(_pool.host).throttled()
+        return super().increment(method, url, response, error, _pool, _stacktrace)
+
+
+def _call_once(fn):
+    called = threading.Event()
+
+    def call_once():
+        if not called.is_set():
+            called.set()
+            fn()
+
+    return call_once
+
+
+class ThrottlingHTTPAdapter(requests.adapters.HTTPAdapter):
+    """
+    HTTPAdapter that limits the requests to each host, see HostThrottle.
+
+    A streamed response counts as a running request until it is closed (or garbage collected),
+    so the limit applies to the whole download, not just to the headers.
+    """
+
+    def send(self, request, stream=False, **kwargs):
+        """Send the request once the HostThrottle allows it."""
+        throttle = get_host_throttle(urllib.parse.urlsplit(request.url).hostname)
+        throttle.concurrency.acquire()
+        release = _call_once(throttle.concurrency.release)
+        try:
+            throttle.acquire_rate()
+            response = super().send(request, stream=stream, **kwargs)
+        except BaseException:
+            release()
+            raise
+
+        if response.status_code not in THROTTLING_STATUSES:
+            throttle.concurrency.increase()
+
+        if not stream:
+            release()
+            return response
+
+        close = response.close
+
+        def close_and_release():
+            try:
+                close()
+            finally:
+                release()
+
+        response.close = close_and_release
+        weakref.finalize(response, release)
+        return response
+
+
+class CachingThrottlingHTTPAdapter(CachingHTTPAdapter, ThrottlingHTTPAdapter):
+    """HTTPAdapter that caches responses and throttles the requests that are actually sent."""
+
+
+_bandwidth_limits: dict[int, TokenBucket] = {}
+_bandwidth_limits_lock = threading.Lock()
+
+
+def limit_bandwidth(nbytes: int) -> None:
+    """
+    Account for downloaded data, wait as needed to stay under the configured max_bandwidth.
+
+    The limit applies to the total of all downloads, a download calls this for each chunk.
+
+    :param int nbytes: number of bytes that were just downloaded
+    """
+    max_bandwidth = get_config().max_bandwidth
+    if max_bandwidth is None:
+        return
+    with _bandwidth_limits_lock:
+        bucket = _bandwidth_limits.get(max_bandwidth)
+        if bucket is None:
+            bucket = TokenBucket(max_bandwidth, max_bandwidth)
+            _bandwidth_limits[max_bandwidth] = bucket
+    bucket.acquire(nbytes)
 
 
-def get_requests_session(retry_options={}):
+def get_requests_session(retry_options={}, cache=False, throttle=False):
     """
     Create a requests session with authentication (when enabled).
 
     :param bool auth: configure authentication on the session
     :param dict retry_options: overwrite options for initialization of Retry instance
+    :param bool cache: cache responses to non-streamed GET requests on disk (if the
+        cache_dir is configured), see HTTPCache
+    :param bool throttle: limit the requests to each host and adapt to overloaded hosts,
+        see HostThrottle
     :return: the configured requests session
     :rtype: requests.Session
     """
@@ -45,7 +382,16 @@ def get_requests_session(retry_options={}):
     #         session.cert = config.cachito_auth_cert
 
     retry_options = {**DEFAULT_RETRY_OPTIONS, **retry_options}
-    adapter = requests.adapters.HTTPAdapter(max_retries=Retry(**retry_options))
+    if cache and throttle:
+        adapter_cls = CachingThrottlingHTTPAdapter
+    elif cache:
+        adapter_cls = CachingHTTPAdapter
+    elif throttle:
+        adapter_cls = ThrottlingHTTPAdapter
+    else:
+        adapter_cls = requests.adapters.HTTPAdapter
+    retry_cls = ThrottlingRetry if throttle else Retry
+    adapter = adapter_cls(max_retries=retry_cls(**retry_options))
     session.mount("http://", adapter)
     session.mount("https://", adapter)
     return session
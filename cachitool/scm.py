@@ -1,27 +1,127 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
+import functools
+import gzip
+import hashlib
+import json
 import logging
 import os
+import re
+import shutil
 import subprocess  # nosec
 import tarfile
 import tempfile
+import urllib.parse
 import zlib
-from pathlib import Path
+from pathlib import Path, PurePosixPath
 from abc import ABC, abstractmethod
 
 import git
 
+from cachitool.checksum import HASH_BUFFER_SIZE, file_digests, remember_digests
+from cachitool.concurrency import cpu_count
+from cachitool.config import get_config
 from cachitool.errors import (
     FileAccessError,
     InvalidRequestData,
     RepositoryAccessError,
     SubprocessCallError,
 )
-from cachitool.util import get_repo_name
+from cachitool.parallel_gzip import ParallelGzipWriter
+from cachitool.util import file_lock, get_repo_name, link_or_copy, strip_url_credentials
 from cachitool.util import run_cmd
 # from cachito.workers.paths import SourcesDir
 
 log = logging.getLogger(__name__)
 
+# Paths in the .git directory that are left out of archives, they are specific to the machine
+# and time they were created on
+EXCLUDED_GIT_PATHS = frozenset({("logs",), ("FETCH_HEAD",)})
+
+GIT_EXECUTABLE_MODE = "100755"
+GIT_SYMLINK_MODE = "120000"
+
+# Errors reported by servers that do not allow fetching commits that are not advertised
+# (i.e. not at the tip of a branch or tag) or that do not support shallow fetches
+UNADVERTISED_COMMIT_ERRORS = (
+    "not our ref",
+    "unadvertised object",
+    "couldn't find remote ref",
+    "does not support shallow",
+)
+
+# Only archives of full commit ids are cached, other refs can move
+COMMIT_SHA_RE = re.compile(r"[0-9a-f]{40}")
+
+
+def normalize_git_url(url: str) -> str:
+    """
+    Normalize a git URL, so that different spellings of the same repository URL are equal.
+
+    Credentials are dropped, the scheme and host are lowercased, a trailing slash and .git
+    suffix are removed.
+    """
+    parsed = urllib.parse.urlsplit(url)
+    netloc = parsed.hostname or ""
+    if parsed.port is not None:
+        netloc = f"{netloc}:{parsed.port}"
+    path = parsed.path.rstrip("/").removesuffix(".git")
+    return urllib.parse.urlunsplit((parsed.scheme.lower(), netloc, path, "", ""))
+
+
+def _get_sidecar_path(archive_path: Path) -> Path:
+    """Get the path of the JSON sidecar of a cached archive (<name>.tar.gz -> <name>.json)."""
+    return archive_path.with_name(archive_path.name.removesuffix(".tar.gz") + ".json")
+
+
+def _write_json(path: Path, data: dict) -> None:
+    """Atomically write a JSON sidecar file, creating the parent directory if needed."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.NamedTemporaryFile("w", dir=path.parent, delete=False) as tmp:
+        json.dump(data, tmp)
+    os.replace(tmp.name, path)
+
+
+def _get_verified_archive_path(digest: str) -> Path | None:
+    """Get the path of the sidecar that records a verified archive, None if caching is off."""
+    cache_dir = get_config().cache_dir
+    if cache_dir is None:
+        return None
+    return cache_dir.verified_archives / digest[:2] / f"{digest}.json"
+
+
+def _is_verified_archive(digest: str) -> bool:
+    """Check if an archive with this sha256 digest was verified by a previous run."""
+    if get_config().paranoid:
+        return False
+    sidecar_path = _get_verified_archive_path(digest)
+    return sidecar_path is not None and sidecar_path.exists()
+
+
+def _record_verified_archive(digest: str, url: str, ref: str) -> None:
+    """Record that an archive with this sha256 digest passed the verification."""
+    sidecar_path = _get_verified_archive_path(digest)
+    if sidecar_path is None:
+        return
+    try:
+        _write_json(sidecar_path, {"url": normalize_git_url(url), "ref": ref})
+    except OSError as e:
+        log.warning("Failed to record the verified archive %s: %s", sidecar_path, e)
+
+
+def _dir_member(arcname: str) -> tarfile.TarInfo:
+    member = tarfile.TarInfo(arcname)
+    member.type = tarfile.DIRTYPE
+    member.mode = 0o755
+    return member
+
+
+def _normalize_member(member: tarfile.TarInfo, mtime: int) -> tarfile.TarInfo:
+    """Make the archive member independent of when and by whom the archive was created."""
+    member.mtime = mtime
+    member.uid = member.gid = 0
+    member.uname = member.gname = ""
+    return member
+
 
 class SCM(ABC):
     """The base class for interacting with source control."""
@@ -51,16 +151,19 @@ class SCM(ABC):
 class Git(SCM):
     """The git implementation of interacting with source control."""
 
-    def _reset_git_head(self, repo):
+    def _reset_git_head(self, repo, working_tree=True):
         """
         Reset HEAD to a specific Git reference.
 
         :param git.Repo repo: the repository object.
+        :param bool working_tree: also check out the files, otherwise only update the index.
         :raises InvalidRequestData: if changing the HEAD of the repository fails.
         """
         try:
-            repo.head.reference = repo.commit(self.ref)
-            repo.head.reset(index=True, working_tree=True)
+            # Write a reflog entry too, submodule updates read the previous HEAD from it and a
+            # repository that was initialized and fetched into has no reflog yet
+            repo.head.set_reference(repo.commit(self.ref), logmsg=f"cachitool: checkout {self.ref}")
+            repo.head.reset(index=True, working_tree=working_tree)
 
         except Exception as ex:
             log.exception(
@@ -74,12 +177,18 @@ class Git(SCM):
                 f'of "{self.ref}" is valid.'
             )
 
-    def _verify_archive(self, path: Path):
+    def _verify_archive(self, path: Path, repo=None):
         """
         Verify the archive containing the git repository.
 
+        Without a repository, the archive is extracted and 'git fsck' runs on the extracted
+        sources. With the repository the archive was created from, the archive is only streamed
+        once to check its integrity and member paths (see _check_archive_members) and 'git fsck'
+        runs on the repository that is already on disk.
+
+        :param git.Repo repo: the repository the archive was created from, if any
         :raises FileAccessError: if the archive is not found
-        :raises SubprocessCallError: if 'git fsck' fails for the extracted sources
+        :raises SubprocessCallError: if the archive is corrupt or 'git fsck' fails
         """
         log.debug("Verifying the archive at %s", path)
         if not os.path.exists(path) or not tarfile.is_tarfile(
@@ -95,11 +204,17 @@ class Git(SCM):
         }
         with tempfile.TemporaryDirectory(prefix="cachito-") as temp_dir:
             cmd = ["git", "fsck"]
-            repo_path = os.path.join(temp_dir, "app")
+            if repo is None:
+                repo_path = os.path.join(temp_dir, "app")
+            else:
+                repo_path = repo.working_dir
             try:
-                with tarfile.open(path, mode="r:gz") as tar:
-                    tar.extractall(temp_dir)
-            except (tarfile.ExtractError, zlib.error, OSError) as exc:
+                if repo is None:
+                    with tarfile.open(path, mode="r:gz") as tar:
+                        tar.extractall(temp_dir)
+                else:
+                    self._check_archive_members(path)
+            except (tarfile.TarError, zlib.error, EOFError, OSError) as exc:
                 log.error(err_msg["log"], path, exc)
                 raise SubprocessCallError(err_msg["exception"])
 
@@ -110,9 +225,41 @@ class Git(SCM):
                 log.error(msg, path, exc, exc.stderr)
                 raise SubprocessCallError(err_msg["exception"])
 
-    def _create_archive(self, from_dir, to_path: Path):
+    @staticmethod
+    def _check_archive_members(path: Path):
         """
-        Create a verified archive from a specified directory.
+        Read the whole archive once and check its members, without extracting anything.
+
+        Reading every member checks the tar header checksums and the gzip CRC, the member
+        paths must stay inside the app/ directory.
+
+        :raises tarfile.TarError/EOFError/OSError: if the archive is corrupt or has an unsafe member
+        """
+        seen = set()
+        with gzip.open(path, "rb") as gz:
+            with tarfile.open(fileobj=gz, mode="r|") as tar:
+                for member in tar:
+                    parts = PurePosixPath(member.name).parts
+                    if member.name.startswith("/") or ".." in parts or parts[:1] != ("app",):
+                        raise tarfile.TarError(f"Unexpected path in the archive: {member.name}")
+                    if member.islnk() and member.linkname not in seen:
+                        raise tarfile.TarError(f"Invalid hard link in the archive: {member.name}")
+                    if not (member.isreg() or member.isdir() or member.issym() or member.islnk()):
+                        raise tarfile.TarError(
+                            f"Unexpected file type in the archive: {member.name}"
+                        )
+                    if member.isreg():
+                        fileobj = tar.extractfile(member)
+                        while fileobj.read(HASH_BUFFER_SIZE):
+                            pass
+                    seen.add(member.name)
+            # tarfile stops at the end-of-archive blocks, gzip checks the CRC at the end of data
+            while gz.read(HASH_BUFFER_SIZE):
+                pass
+
+    def _create_archive(self, to_path: Path, add_members, repo=None):
+        """
+        Create a verified, reproducible archive.
 
         We first create the archive in a temporary path so other tasks will not
         use it while it is being written. Note that this operation must be done
@@ -120,7 +267,16 @@ class Git(SCM):
         would result in the same issue as writting the archive directly to the
         final path
 
-        :param str from_dir: path to a directory from where to create the archive.
+        The archive is compressed on several threads (see ParallelGzipWriter). The gzip header
+        has no timestamp and no file name, so that the archive only depends on the members added
+        by add_members and on the compression level.
+
+        Verified archives are recorded by their digest in the cache directory. Archives are
+        reproducible, so the same archive created by a later run is not verified again.
+
+        :param Path to_path: create the archive at this path.
+        :param add_members: function that adds the members to a tarfile.TarFile
+        :param git.Repo repo: the repository the archive is created from, see _verify_archive
         :raises FileAccessError/SubprocessCallError: if the archive verification fails
         """
         temp_archive_prefix = "tmp-archive-"
@@ -133,8 +289,14 @@ class Git(SCM):
             dir=to_path.parent,
         ) as tmp:
             log.debug("Creating the archive at %s", tmp.name)
-            with tarfile.open(fileobj=tmp, mode="w:gz") as bundle_archive:
-                bundle_archive.add(from_dir, "app")
+            config = get_config()
+            with ParallelGzipWriter(
+                tmp,
+                threads=config.archive_threads or cpu_count(),
+                compresslevel=config.archive_compression_level,
+            ) as gz:
+                with tarfile.open(fileobj=gz, mode="w", format=tarfile.PAX_FORMAT) as archive:
+                    add_members(archive)
             # Make sure the file is written before linking it
             tmp.flush()
             os.fsync(tmp.fileno())
@@ -147,48 +309,323 @@ class Git(SCM):
                     "%s was created while this task was running. Will proceed with that archive",
                     to_path,
                 )
+        digest = file_digests(to_path, ["sha256"])["sha256"]
+        if _is_verified_archive(digest):
+            log.debug("The archive at %s was already verified (sha256:%s)", to_path, digest)
+            return
         try:
-            self._verify_archive(to_path)
+            self._verify_archive(to_path, repo)
         except (FileAccessError, SubprocessCallError):
             log.debug("Removing invalid archive at %s", to_path)
             os.unlink(to_path)
             raise
+        _record_verified_archive(digest, self.url, self.ref)
 
-    def clone_and_archive(self, to_path: Path, gitsubmodule=False):
+    def _clone(self, clone_path: str):
         """
-        Clone the git repository and create the compressed source archive.
+        Clone the git repository from the URL.
 
-        :param bool gitsubmodule: a bool to determine whether git submodules need to be processed.
-        :raises RepositoryAccessError: if cloning the repository fails or archive can't be created
+        :param str clone_path: clone the repository to this path.
+        :return: the cloned repository.
+        :rtype: git.Repo
+        :raises RepositoryAccessError: if cloning the repository fails
         """
-        with tempfile.TemporaryDirectory(prefix="cachito-") as temp_dir:
-            log.debug("Cloning the Git repository from %s", self.url)
-            clone_path = os.path.join(temp_dir, "repo")
+        log.debug("Cloning the Git repository from %s", self.url)
+        try:
+            return git.repo.Repo.clone_from(
+                self.url,
+                clone_path,
+                no_checkout=True,
+                # Not a partial (blob:none) clone, the archive reads every blob of the commit
+                # and each missing blob would be fetched from the server on its own
+                # Don't allow git to prompt for a username if we don't have access
+                env={"GIT_TERMINAL_PROMPT": "0"},
+            )
+        except Exception as ex:
+            log.exception(
+                "Failed cloning the Git repository from %s, ref: %s, exception: %s",
+                self.url,
+                self.ref,
+                type(ex).__name__,
+            )
+            raise RepositoryAccessError("Failed cloning the Git repository")
+
+    def _has_commit(self, repo) -> bool:
+        try:
+            repo.git.cat_file("-e", f"{self.ref}^{{commit}}")
+            return True
+        except git.exc.GitCommandError:
+            return False
+
+    def _fetch_exact_commit(self, repo, source: str) -> bool:
+        """
+        Fetch just the commit for the ref, without any history (git fetch --depth 1).
+
+        Not all servers allow this (e.g. servers that do not allow fetching commits that they
+        don't advertise, or dumb HTTP servers, which don't support shallow fetches). If the fetch
+        fails for any reason, the caller falls back to fetching the whole repository, which
+        reports the error if the repository can't be fetched at all.
+
+        :param git.Repo repo: fetch into this repository.
+        :param str source: the remote name or URL to fetch from.
+        :return: True if the commit was fetched, False if fetching just the commit failed.
+        """
+        try:
+            repo.git.fetch(
+                "--depth", "1", "--no-tags", source, self.ref, env={"GIT_TERMINAL_PROMPT": "0"}
+            )
+            return True
+        except git.exc.GitCommandError as ex:
+            stderr = str(ex.stderr).strip()
+            if any(error in stderr for error in UNADVERTISED_COMMIT_ERRORS):
+                log.debug("%s does not allow fetching %s directly", self.url, self.ref)
+            else:
+                log.warning(
+                    "Failed fetching just %s from %s, will fetch the whole repository: %s",
+                    self.ref,
+                    strip_url_credentials(self.url),
+                    stderr,
+                )
+            return False
+
+    def _update_mirror(self, mirror_path: Path):
+        """
+        Make sure the bare mirror of the repository contains the commit for the ref.
+
+        Only fetch from the URL if the commit is missing. Fetch just the commit first (see
+        _fetch_exact_commit), not all servers allow that, so fall back to fetching all branches
+        and tags. The caller must hold the lock for the mirror.
+
+        :param Path mirror_path: path to the bare mirror, created if it does not exist.
+        :return: the mirror repository.
+        :rtype: git.Repo
+        :raises RepositoryAccessError: if fetching from the URL fails
+        """
+        try:
+            mirror = git.Repo(mirror_path)
+        except (git.exc.InvalidGitRepositoryError, git.exc.NoSuchPathError):
+            log.debug("Creating a mirror of %s at %s", self.url, mirror_path)
+            shutil.rmtree(mirror_path, ignore_errors=True)
+            mirror = git.Repo.init(mirror_path, bare=True)
+            with mirror.config_writer() as config:
+                # Fetched commits are kept alive by refs/cachitool/*, no need for gc
+                config.set_value("gc", "auto", "0")
+
+        if self._has_commit(mirror):
+            log.debug("The mirror of %s already has %s", self.url, self.ref)
+        else:
+            self._fetch_into_mirror(mirror)
+
+        # Also makes the commit a ref tip, which can always be fetched from the mirror
+        mirror.git.update_ref(f"refs/cachitool/{self.ref}", self.ref)
+        return mirror
+
+    def _fetch_into_mirror(self, mirror):
+        log.debug("Fetching %s from %s into the mirror", self.ref, self.url)
+        if not self._fetch_exact_commit(mirror, self.url):
+            log.debug("Fetching all branches and tags of %s into the mirror", self.url)
             try:
-                repo = git.repo.Repo.clone_from(
+                mirror.git.fetch(
                     self.url,
-                    clone_path,
-                    no_checkout=True,
-                    filter="blob:none",
-                    # Don't allow git to prompt for a username if we don't have access
+                    "+refs/heads/*:refs/heads/*",
+                    "+refs/tags/*:refs/tags/*",
                     env={"GIT_TERMINAL_PROMPT": "0"},
                 )
             except Exception as ex:
                 log.exception(
-                    "Failed cloning the Git repository from %s, ref: %s, exception: %s",
+                    "Failed fetching from the Git repository %s, ref: %s, exception: %s",
                     self.url,
                     self.ref,
                     type(ex).__name__,
                 )
                 raise RepositoryAccessError("Failed cloning the Git repository")
 
-            self._reset_git_head(repo)
+        if not self._has_commit(mirror):
+            raise InvalidRequestData(
+                "Failed on checking out the Git repository. Please verify the supplied reference "
+                f'of "{self.ref}" is valid.'
+            )
+
+    def _init_repo(self, clone_path: str):
+        repo = git.Repo.init(clone_path)
+        repo.create_remote("origin", self.url)
+        return repo
+
+    def _clone_from_mirror(self, mirrors_dir: Path, clone_path: str):
+        """
+        Fetch the commit for the ref through a persistent bare mirror of the URL.
+
+        The mirror lives in mirrors_dir and is shared between runs (and concurrent processes,
+        it is protected by a lock file). The new repository gets just the commit from the mirror,
+        without any history.
+
+        :param Path mirrors_dir: directory with the mirrors of all repositories
+        :param str clone_path: create the repository at this path.
+        :return: the new repository, with origin pointing to the original URL.
+        :rtype: git.Repo
+        :raises RepositoryAccessError: if fetching from the URL or from the mirror fails
+        """
+        mirrors_dir.mkdir(parents=True, exist_ok=True)
+        mirror_name = hashlib.sha256(self.url.encode()).hexdigest()
+        mirror_path = mirrors_dir / f"{mirror_name}.git"
+
+        with file_lock(mirrors_dir / f"{mirror_name}.lock"):
+            self._update_mirror(mirror_path)
+            log.debug("Fetching %s from the mirror of %s", self.ref, self.url)
+            repo = self._init_repo(clone_path)
+            try:
+                repo.git.fetch("--depth", "1", "--no-tags", mirror_path.as_uri(), self.ref)
+            except git.exc.GitCommandError:
+                # The mirror is most likely corrupted (e.g. by an interrupted run), rebuild it
+                log.warning(
+                    "Failed fetching %s from the mirror of %s, creating the mirror again",
+                    self.ref,
+                    self.url,
+                    exc_info=True,
+                )
+                shutil.rmtree(mirror_path)
+                self._update_mirror(mirror_path)
+                try:
+                    repo.git.fetch("--depth", "1", "--no-tags", mirror_path.as_uri(), self.ref)
+                except Exception as ex:
+                    log.exception(
+                        "Failed fetching from the mirror of the Git repository %s, ref: %s, "
+                        "exception: %s",
+                        self.url,
+                        self.ref,
+                        type(ex).__name__,
+                    )
+                    raise RepositoryAccessError("Failed cloning the Git repository")
+
+        return repo
+
+    def _add_directory_to_archive(self, repo, archive: tarfile.TarFile):
+        """Add the checked out repository to the archive as app/, see _normalize_member."""
+        mtime = repo.head.commit.committed_date
+
+        def normalize(member):
+            relpath = PurePosixPath(member.name).relative_to("app")
+            if relpath.parts[:1] == (".git",) and relpath.parts[1:2] in EXCLUDED_GIT_PATHS:
+                return None
+            return _normalize_member(member, mtime)
+
+        # TarFile.add() adds the contents of directories in sorted order
+        archive.add(repo.working_dir, "app", filter=normalize)
+
+    def _add_commit_to_archive(self, repo, archive: tarfile.TarFile):
+        """
+        Add the tree of the commit for the ref and the .git directory to the archive as app/.
+
+        The files are streamed from git objects, nothing is checked out. Members are sorted by
+        path and normalized (see _normalize_member), so the archive is reproducible.
+        """
+        commit = repo.commit(self.ref)
+        mtime = commit.committed_date
+        # relpath => function that adds the member
+        members = {}
+
+        ls_tree = repo.git.ls_tree(
+            "-r", "-t", "-z", "--full-tree", commit.hexsha, stdout_as_string=False
+        )
+        for entry in ls_tree.split(b"\0"):
+            if not entry:
+                continue
+            info, _, path = entry.partition(b"\t")
+            mode, obj_type, sha = info.decode().split()
+            relpath = os.fsdecode(path)
+            members[relpath] = functools.partial(
+                self._add_git_object, repo, archive, f"app/{relpath}", mode, obj_type, sha, mtime
+            )
+
+        git_dir = Path(repo.git_dir)
+        members[".git"] = functools.partial(self._add_file, archive, git_dir, "app/.git", mtime)
+        for dirpath, dirnames, filenames in os.walk(git_dir):
+            if Path(dirpath) == git_dir:
+                dirnames[:] = [name for name in dirnames if (name,) not in EXCLUDED_GIT_PATHS]
+                filenames = [name for name in filenames if (name,) not in EXCLUDED_GIT_PATHS]
+            for name in dirnames + filenames:
+                path = Path(dirpath, name)
+                relpath = f".git/{path.relative_to(git_dir)}"
+                members[relpath] = functools.partial(
+                    self._add_file, archive, path, f"app/{relpath}", mtime
+                )
+
+        archive.addfile(_normalize_member(_dir_member("app"), mtime))
+        for relpath in sorted(members):
+            members[relpath]()
+
+    @staticmethod
+    def _add_file(archive: tarfile.TarFile, path: Path, arcname: str, mtime: int):
+        member = _normalize_member(archive.gettarinfo(path, arcname), mtime)
+        if member.isreg():
+            with open(path, "rb") as f:
+                archive.addfile(member, f)
+        else:
+            archive.addfile(member)
+
+    @staticmethod
+    def _add_git_object(
+        repo, archive: tarfile.TarFile, arcname: str, mode: str, obj_type: str, sha: str, mtime: int
+    ):
+        if obj_type != "blob":
+            # A tree, or a commit (submodule), which is checked out as an empty directory
+            archive.addfile(_normalize_member(_dir_member(arcname), mtime))
+            return
+
+        _, _, size, stream = repo.git.stream_object_data(sha)
+        member = tarfile.TarInfo(arcname)
+        if mode == GIT_SYMLINK_MODE:
+            member.type = tarfile.SYMTYPE
+            member.linkname = os.fsdecode(stream.read())
+            member.mode = 0o777
+            archive.addfile(_normalize_member(member, mtime))
+        else:
+            member.size = size
+            member.mode = 0o755 if mode == GIT_EXECUTABLE_MODE else 0o644
+            # Reads exactly size bytes, straight from git cat-file
+            archive.addfile(_normalize_member(member, mtime), stream)
+
+    def clone_and_archive(self, to_path: Path, gitsubmodule=False):
+        """
+        Fetch the commit for the git ref and create the compressed source archive.
+
+        Only the commit itself is fetched, without any history (see _fetch_exact_commit). If the
+        server does not allow that, clone the whole repository instead. If caching is enabled,
+        fetch through a persistent mirror of the repository (see _clone_from_mirror).
+
+        :param bool gitsubmodule: a bool to determine whether git submodules need to be processed.
+        :raises RepositoryAccessError: if cloning the repository fails or archive can't be created
+        """
+        with tempfile.TemporaryDirectory(prefix="cachito-") as temp_dir:
+            clone_path = os.path.join(temp_dir, "repo")
+            cache_dir = get_config().cache_dir
+            # A shallow fetch gets exactly the needed objects, a full clone needs to be pruned
+            needs_gc = False
+            if cache_dir is not None:
+                repo = self._clone_from_mirror(cache_dir.git_mirrors, clone_path)
+            else:
+                log.debug("Fetching %s from %s", self.ref, self.url)
+                repo = self._init_repo(clone_path)
+                if not self._fetch_exact_commit(repo, "origin"):
+                    shutil.rmtree(clone_path)
+                    repo = self._clone(clone_path)
+                    needs_gc = True
 
             if gitsubmodule:
+                # Submodules are cloned into the working tree, archive the checked out files
+                self._reset_git_head(repo)
                 self.update_git_submodules(repo)
-
-            repo.git.gc("--prune=now")
-            self._create_archive(repo.working_dir, to_path)
+                add_members = functools.partial(self._add_directory_to_archive, repo)
+            else:
+                # Only write the index, the files are streamed from git objects
+                self._reset_git_head(repo, working_tree=False)
+                add_members = functools.partial(self._add_commit_to_archive, repo)
+
+            if needs_gc:
+                repo.git.gc("--prune=now")
+            # The archive includes .git/config, don't leak the credentials from the URL
+            repo.remote("origin").set_url(strip_url_credentials(self.url))
+            self._create_archive(to_path, add_members, repo)
 
     # def update_and_archive(self, previous_archive, gitsubmodule=False):
     #     """
@@ -225,12 +662,91 @@ class Git(SCM):
     #         repo.git.gc("--prune=now")
     #         self._create_archive(repo.working_dir)
 
+    def _get_cached_archive_path(self, gitsubmodule: bool) -> Path | None:
+        """
+        Get the path of the archive in the cache, keyed by the URL, commit and submodules flag.
+
+        The credentials in the URL are part of the key (only the hash of the key is stored), so
+        an archive fetched with some credentials is not given to a request without them.
+
+        :return: the path (the archive may not exist yet) or None if the archive is not cacheable
+        """
+        cache_dir = get_config().cache_dir
+        if cache_dir is None or not COMMIT_SHA_RE.fullmatch(self.ref):
+            return None
+        credentials = urllib.parse.urlsplit(self.url).netloc.rpartition("@")[0]
+        key_data = json.dumps([normalize_git_url(self.url), credentials, self.ref, gitsubmodule])
+        key = hashlib.sha256(key_data.encode()).hexdigest()
+        return cache_dir.vcs_archives / key[:2] / f"{key}.tar.gz"
+
+    def _materialize_cached_archive(self, cached_path: Path, to_path: Path) -> bool:
+        """
+        Put the cached archive at to_path, if it is in the cache and has the recorded digest.
+
+        Cached archives that do not match the recorded digest are removed from the cache.
+
+        :return: True if the archive was materialized from the cache
+        """
+        sidecar_path = _get_sidecar_path(cached_path)
+        try:
+            expected_digest = json.loads(sidecar_path.read_text())["sha256"]
+            actual_digest = file_digests(cached_path, ["sha256"])["sha256"]
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError, KeyError) as e:
+            log.warning("Ignoring invalid cached archive %s: %s", cached_path, e)
+            return False
+
+        if actual_digest != expected_digest:
+            log.warning(
+                "The cached archive %s does not match its recorded digest (sha256:%s), "
+                "it will be re-created",
+                cached_path,
+                expected_digest,
+            )
+            for path in (sidecar_path, cached_path):
+                path.unlink(missing_ok=True)
+            return False
+
+        log.info("Using the cached archive of %s at %s", self.url, self.ref)
+        link_or_copy(cached_path, to_path)
+        remember_digests(to_path, {"sha256": actual_digest})
+        return True
+
+    def _add_to_archive_cache(self, archive_path: Path, cached_path: Path, gitsubmodule: bool):
+        """Add a new, verified archive to the cache and record its digest."""
+        try:
+            cached_path.parent.mkdir(parents=True, exist_ok=True)
+            link_or_copy(archive_path, cached_path)
+            cached_path.chmod(0o444)
+            digest = file_digests(cached_path, ["sha256"])["sha256"]
+            # The sidecar is written last, an archive without it is not used
+            _write_json(
+                _get_sidecar_path(cached_path),
+                {
+                    "url": normalize_git_url(self.url),
+                    "ref": self.ref,
+                    "gitsubmodule": gitsubmodule,
+                    "sha256": digest,
+                },
+            )
+        except OSError as e:
+            log.warning("Failed to add the archive %s to the cache: %s", archive_path, e)
+
     def fetch_source(self, to_path: Path, gitsubmodule=False):
         """Fetch the repo and create a compressed tar file.
 
+        If caching is enabled, archives of commits are cached by the (normalized) URL and its
+        credentials, commit id and the submodules flag. A cached archive is reused if it still has
+        the digest recorded when it was added, it is linked to to_path (see link_or_copy).
+
         :param to_path: create archive at this path
         :param bool gitsubmodule: a bool to determine whether git submodules need to be processed.
         """
+        cached_path = self._get_cached_archive_path(gitsubmodule)
+        if cached_path is not None and self._materialize_cached_archive(cached_path, to_path):
+            return
+
         # if gitsubmodule:
         #     self.sources_dir = SourcesDir(self.repo_name, f"{self.ref}-with-submodules")
 
@@ -278,6 +794,8 @@ class Git(SCM):
         #         )
 
         self.clone_and_archive(to_path, gitsubmodule=gitsubmodule)
+        if cached_path is not None:
+            self._add_to_archive_cache(to_path, cached_path, gitsubmodule)
 
     def update_git_submodules(self, repo):
         """Update git submodules.
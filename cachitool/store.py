@@ -0,0 +1,119 @@
+import hashlib
+import logging
+import os
+import re
+from pathlib import Path
+
+from cachitool.checksum import file_digests
+from cachitool.util import link_or_copy
+
+log = logging.getLogger(__name__)
+
+STORE_ALGORITHM = "sha256"
+
+_HEX_DIGEST = re.compile(r"[0-9a-f]+")
+
+
+def _is_valid_digest(algorithm: str, digest: str) -> bool:
+    """Check that the digest is a hex digest of the right length for a known algorithm."""
+    if algorithm not in hashlib.algorithms_guaranteed:
+        return False
+    digest_size = hashlib.new(algorithm).digest_size
+    # Variable length algorithms (shake) have a digest_size of 0
+    if digest_size == 0 or len(digest) != 2 * digest_size:
+        return False
+    return _HEX_DIGEST.fullmatch(digest) is not None
+
+
+class ArtifactStore:
+    """
+    Content-addressable store for downloaded files, shared between output directories.
+
+    Files are stored as <root>/sha256/<digest[:2]>/<digest> and are read-only. Digests
+    computed with other algorithms are recorded as symlinks in <root>/<algorithm>/, pointing
+    to the sha256 object, so that files can be looked up by any hash that we know in advance.
+
+    Files are placed in output directories by hardlink, reflink or copy (see link_or_copy).
+    """
+
+    def __init__(self, root: Path):
+        """
+        Initialize an ArtifactStore.
+
+        :param Path root: the root directory of the store
+        """
+        self.root = root
+
+    def _object_path(self, algorithm: str, digest: str) -> Path:
+        digest = digest.lower()
+        return self.root / algorithm / digest[:2] / digest
+
+    def find(self, hashes: dict[str, str]) -> tuple[Path, dict[str, str]] | None:
+        """
+        Find a stored file by any of its hashes.
+
+        Hashes that are not valid hex digests for a known algorithm are ignored.
+
+        :param dict hashes: mapping of algorithm name to hex digest
+        :return: path to the stored file and the digests that are claimed for it
+            (the matching one and sha256, the file is not read), or None if not found
+        """
+        for algorithm, digest in hashes.items():
+            digest = (digest or "").lower()
+            if not _is_valid_digest(algorithm, digest):
+                continue
+            path = self._object_path(algorithm, digest)
+            # For aliases, exists() also checks that the sha256 object still exists
+            if path.exists():
+                object_path = path.resolve()
+                return object_path, {algorithm: digest, STORE_ALGORITHM: object_path.name}
+        return None
+
+    def materialize(self, stored_path: Path, dest: Path) -> None:
+        """Put a stored file at dest (by hardlink, reflink or copy)."""
+        log.debug("Linking %s from the artifact store to %s", dest.name, dest)
+        link_or_copy(stored_path, dest)
+
+    def discard(self, stored_path: Path) -> None:
+        """Remove a (corrupted) stored file, its aliases become dangling and are not found."""
+        log.debug("Removing %s from the artifact store", stored_path)
+        stored_path.unlink(missing_ok=True)
+
+    def add(self, path: Path, digests: dict[str, str] | None = None) -> Path:
+        """
+        Add a file to the store and replace the original with a link to the stored object.
+
+        :param Path path: the file to add
+        :param dict digests: already computed hex digests of the file, mapping of algorithm
+            name to digest. If sha256 is missing, it will be computed. Digests for other
+            algorithms will be recorded as aliases.
+        :return: path to the stored file
+        """
+        digests = dict(digests or {})
+        if STORE_ALGORITHM not in digests:
+            digests.update(file_digests(path, [STORE_ALGORITHM]))
+
+        object_path = self._object_path(STORE_ALGORITHM, digests[STORE_ALGORITHM])
+        object_path.parent.mkdir(parents=True, exist_ok=True)
+
+        if object_path.exists():
+            log.debug("%s is already in the artifact store", path.name)
+        else:
+            log.debug("Adding %s to the artifact store", path.name)
+            link_or_copy(path, object_path)
+            object_path.chmod(0o444)
+
+        if not object_path.samefile(path):
+            link_or_copy(object_path, path)
+
+        for algorithm, digest in digests.items():
+            if algorithm == STORE_ALGORITHM:
+                continue
+            alias_path = self._object_path(algorithm, digest)
+            alias_path.parent.mkdir(parents=True, exist_ok=True)
+            try:
+                alias_path.symlink_to(os.path.relpath(object_path, alias_path.parent))
+            except FileExistsError:
+                pass
+
+        return object_path
@@ -1,8 +1,14 @@
+import contextlib
+import errno
+import fcntl
 import logging
 import os.path
+import shutil
 import subprocess
+import tempfile
 import urllib
 from pathlib import Path
+from typing import Iterator
 
 from cachitool.errors import SubprocessCallError, CachitoCalledProcessError
 
@@ -14,6 +20,54 @@ def normpath(path: str | Path) -> Path:
     return Path(os.path.normpath(path))
 
 
+# ioctl request for cloning a file (reflink) on filesystems that support it (btrfs, xfs)
+_FICLONE = 0x40049409
+
+
+def _reflink(src: Path, dest: Path) -> None:
+    with open(src, "rb") as src_f, open(dest, "wb") as dest_f:
+        fcntl.ioctl(dest_f.fileno(), _FICLONE, src_f.fileno())
+
+
+def link_or_copy(src: str | Path, dest: str | Path) -> None:
+    """
+    Make the file at dest have the same content as src, as cheaply as possible.
+
+    Try a hardlink first, then a reflink, then fall back to a copy. Replaces dest atomically
+    if it already exists.
+    """
+    dest = Path(dest)
+    with tempfile.TemporaryDirectory(dir=dest.parent, prefix=".link-") as tmpdir:
+        tmp_dest = Path(tmpdir, dest.name)
+        try:
+            os.link(src, tmp_dest)
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+            try:
+                _reflink(src, tmp_dest)
+            except OSError:
+                log.debug("Cannot link or reflink %s to %s, will copy", src, dest)
+                shutil.copyfile(src, tmp_dest)
+        os.replace(tmp_dest, dest)
+
+
+@contextlib.contextmanager
+def file_lock(path: str | Path, shared: bool = False) -> Iterator[None]:
+    """
+    Hold an flock() on the file at path (created if needed) while the context is active.
+
+    :param path: path to the lock file
+    :param bool shared: take a shared lock instead of an exclusive one
+    """
+    with open(path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
 def get_repo_name(url: str) -> str:
     """Get the repo name from the URL."""
     parsed_url = urllib.parse.urlparse(url)
@@ -23,6 +77,13 @@ def get_repo_name(url: str) -> str:
     return repo
 
 
+def strip_url_credentials(url: str) -> str:
+    """Remove the user name and password (e.g. an access token) from the URL."""
+    parsed_url = urllib.parse.urlsplit(url)
+    netloc = parsed_url.netloc.rpartition("@")[2]
+    return urllib.parse.urlunsplit(parsed_url._replace(netloc=netloc))
+
+
 def run_cmd(cmd, params, exc_msg=None):
     """
     Run the given command with provided parameters.
@@ -0,0 +1,41 @@
+import json
+import subprocess
+import sys
+import time
+
+# Modules that are slow to import, apply-configs must not need any of them
+HEAVY_MODULES = ("requests", "git", "bs4", "pydantic", "pkg_resources", "piprepo")
+
+# Generous, apply-configs starts in about 0.1s, importing the heavy modules takes about 1s
+STARTUP_BUDGET_SECONDS = 5
+
+APPLY_CONFIGS = """
+import sys
+from cachitool import main
+
+parser = main.make_parser()
+args = parser.parse_args(["apply-configs", "--from-output-dir", sys.argv[1]])
+args.run_fn(args.convert_fn(args))
+print(",".join(name for name in sys.argv[2:] if name in sys.modules))
+"""
+
+
+def test_apply_configs_does_not_import_heavy_modules(tmp_path):
+    config_file = tmp_path / "app" / "requirements.txt"
+    config_file.parent.mkdir()
+    (tmp_path / "configs.json").write_text(
+        json.dumps([{"abspath": str(config_file), "content": "six==1.16.0\n"}])
+    )
+
+    start = time.monotonic()
+    result = subprocess.run(
+        [sys.executable, "-c", APPLY_CONFIGS, str(tmp_path), *HEAVY_MODULES],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    elapsed = time.monotonic() - start
+
+    assert result.stdout.strip() == ""
+    assert config_file.read_text() == "six==1.16.0\n"
+    assert elapsed < STARTUP_BUDGET_SECONDS